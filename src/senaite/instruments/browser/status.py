@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+
+import json
+
+from AccessControl.SecurityManagement import getSecurityManager
+from Products.Five.browser import BrowserView
+from senaite.instruments.jobs import get_job
+
+
+class ImportStatusView(BrowserView):
+    """Returns the state, progress and result of a background import job as
+    JSON. Only the user who submitted the import can see its job.
+    """
+
+    def __call__(self):
+        self.request.response.setHeader("Content-Type", "application/json")
+        job = get_job(self.request.form.get("job_id", ""))
+        user_id = getSecurityManager().getUser().getId()
+        if job is None or job.user_id != user_id:
+            self.request.response.setStatus(404)
+            return json.dumps({"errors": ["Import job not found"],
+                               "log": [],
+                               "warns": []})
+        return json.dumps(job.to_dict())
@@ -1,13 +1,60 @@
+import atexit
+import codecs
+import cPickle
+import csv
+import hashlib
+import mmap
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
 import types
+import zipfile
+import zlib
+from collections import OrderedDict
+from mimetypes import guess_type
 
-import openpyxl
+import transaction
 from openpyxl import load_workbook
+from bika.lims import api
 from senaite.core.exportimport.instruments.resultsimport import \
     InstrumentResultsFileParser
 from cStringIO import StringIO
+from senaite.instruments import logger
+from senaite.instruments.utils import get_analyses_by_sample
+from senaite.instruments.utils import get_samples
+from xlrd import XL_CELL_BLANK
+from xlrd import XL_CELL_EMPTY
+from xlrd import XL_CELL_ERROR
 from xlrd import open_workbook
 from zope.publisher.browser import FileUpload
 
+XLS_EMPTY_CELLS = (XL_CELL_EMPTY, XL_CELL_BLANK, XL_CELL_ERROR)
+
+# Leading bytes used to detect the format of an uploaded file
+ZIP_MAGIC = "PK\x03\x04"
+OLE2_MAGIC = "\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+TEXT_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+SNIFF_SIZE = 512
+
+# Member of the zip container of xlsx (OOXML) files
+OOXML_CONTENT_TYPES = "[Content_Types].xml"
+
+# Uploads larger than this (in bytes) are memory mapped for the conversion
+SPOOL_THRESHOLD = 4 * 1024 * 1024
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+# Number of converted sheets kept in the cache and number of rows per sheet
+# that are kept in memory. Rows beyond are spilled to a temporary file.
+SHEET_CACHE_SIZE = 8
+SHEET_CACHE_MAX_ROWS = 5000
+
 
 def xls_to_csv(infile, worksheet=0, delimiter=","):
     # TODO: Move to utility module
@@ -16,56 +63,517 @@ def xls_to_csv(infile, worksheet=0, delimiter=","):
     convenience of the CSV library
 
     """
-
-    def find_sheet(wb, worksheet):
-        for sheet in wb.sheets():
-            if sheet.name == worksheet:
-                return sheet
-
-    wb = open_workbook(file_contents=infile.read())
-    sheet = wb.sheets()[worksheet]
-
     buffer = StringIO()
 
     # extract all rows
-    for row in sheet.get_rows():
+    for row in xls_rows(infile, worksheet=worksheet):
         line = []
-        for cell in row:
-            value = cell.value
+        for value in row:
             if type(value) in types.StringTypes:
                 value = value.encode("utf8")
             if value is None:
                 value = ""
+            if isinstance(value, float):
+                value = repr(value)
             line.append(str(value))
         print >> buffer, delimiter.join(line)
     buffer.seek(0)
     return buffer
 
+
 class SheetNotFound(Exception):
     """
     Sheet not found in workbook
     """
 
-def xlsx_to_csv(infile, worksheet=None, delimiter=","):
-    worksheet = worksheet if worksheet else 0
-    wb = load_workbook(filename=infile)
+
+class UnsupportedFormat(Exception):
+    """
+    File is neither a spreadsheet nor a text file
+    """
+
+
+def cell_to_text(value):
+    """Return the cell value as it used to be written to the csv buffer
+    """
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        value = value.encode("utf8")
+    elif isinstance(value, float):
+        # repr keeps all significant digits of the float
+        value = repr(value)
+    else:
+        value = str(value)
+    if "\n" in value:  # fixme multi-line cell gives only first line
+        value = value.split("\n")[0]
+    return value.strip()
+
+
+def cell_value(value):
+    """Return the typed value of a cell
+
+    Numbers are returned untouched, text is converted like in cell_to_text
+    and empty cells are returned as None
+    """
+    if isinstance(value, types.StringTypes):
+        return cell_to_text(value) or None
+    return value
+
+
+def to_float(value, default=None):
+    """Convert a cell value to float, or return default if not numeric
+
+    Numeric cells are returned without being parsed again, only text values
+    are converted with float().
+    """
+    if isinstance(value, float):
+        return value
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, long)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_xlsx_sheet(wb, worksheet):
+    """Return the worksheet of the workbook by name or by index
+    """
     if worksheet in wb.sheetnames:
-        sheet = wb[worksheet]
+        return wb[worksheet]
+    try:
+        index = int(worksheet)
+        return wb.worksheets[index]
+    except (ValueError, TypeError, IndexError):
+        raise SheetNotFound
+
+
+def xlsx_rows(infile, worksheet=None):
+    """Return an iterator over the rows of an xlsx worksheet
+
+    The workbook is opened in read-only mode, so the rows are streamed from
+    the sheet's xml and only the current row is kept in memory. Rows are
+    tuples of the raw cell values.
+
+    The dimension stored in the sheet is not trusted, as other writers than
+    Excel often store a wrong one, which would cut the rows read.
+    """
+    worksheet = worksheet if worksheet else 0
+    wb = load_workbook(filename=infile, read_only=True)
+    try:
+        sheet = get_xlsx_sheet(wb, worksheet)
+    except SheetNotFound:
+        wb.close()
+        raise
+
+    def rows():
+        try:
+            sheet.reset_dimensions()
+            for row in sheet.iter_rows(values_only=True):
+                yield row
+        finally:
+            wb.close()
+
+    return rows()
+
+
+def get_xls_sheet(wb, worksheet):
+    """Load the worksheet of an on-demand workbook by name or by index
+    """
+    if worksheet in wb.sheet_names():
+        return wb.sheet_by_name(worksheet)
+    try:
+        index = int(worksheet)
+        return wb.sheet_by_index(index)
+    except (ValueError, TypeError, IndexError):
+        raise SheetNotFound
+
+
+def xls_rows(infile, worksheet=0):
+    """Return an iterator over the rows of an xls worksheet
+
+    The workbook is opened on demand, so only the requested sheet is parsed.
+    Numbers are returned as floats and empty or error cells as None. The
+    sheet is unloaded and the workbook resources are released once all
+    rows were read.
+    """
+    wb = open_workbook(file_contents=file_contents(infile), on_demand=True)
+    try:
+        sheet = get_xls_sheet(wb, worksheet)
+    except SheetNotFound:
+        wb.release_resources()
+        raise
+
+    def rows():
+        try:
+            for row in sheet.get_rows():
+                yield [None if cell.ctype in XLS_EMPTY_CELLS else cell.value
+                       for cell in row]
+        finally:
+            wb.unload_sheet(sheet.name)
+            wb.release_resources()
+
+    return rows()
+
+
+def csv_rows(infile, delimiter=",", encoding=None):
+    """Return an iterator over the rows of a csv file
+
+    Lines are read one by one from the file instead of loading them at once.
+    Note that all values of a csv file are text. If an encoding is given,
+    the lines are decoded with it and passed as utf8 to the csv reader.
+    """
+    if encoding:
+        reader = codecs.getreader(encoding)(infile)
+        lines = (line.encode("utf8") for line in iter(reader.readline, u""))
     else:
+        lines = iter(infile.readline, "")
+    return csv.reader(lines, delimiter=delimiter)
+
+
+def sniff_format(infile):
+    """Detect the format of the file from its leading bytes
+
+    Returns a tuple of the format, which is "xlsx", "xls" or "csv", and the
+    encoding of the text, which is only set when a byte order mark is found.
+    The file is rewound afterwards.
+    """
+    infile.seek(0)
+    head = infile.read(SNIFF_SIZE)
+    infile.seek(0)
+    if head.startswith(ZIP_MAGIC):
+        return "xlsx", None
+    if head.startswith(OLE2_MAGIC):
+        return "xls", None
+    for bom, encoding in TEXT_BOMS:
+        if head.startswith(bom):
+            return "csv", encoding
+    if "\x00" in head:
+        raise UnsupportedFormat
+    return "csv", None
+
+
+def expand_uploads(uploads, invalid=None):
+    """Return the uploads, with the files of zip archives in place of the
+    archives
+
+    Zip files which are xlsx workbooks are kept as they are. Archives which
+    cannot be read are left out and added to the invalid list, if given,
+    else the error is raised.
+    """
+    files = []
+    for upload in uploads:
+        upload.seek(0)
+        head = upload.read(len(ZIP_MAGIC))
+        upload.seek(0)
+        if head != ZIP_MAGIC:
+            files.append(upload)
+            continue
+        try:
+            files.extend(extract_archive(upload))
+        except (zipfile.BadZipfile, zlib.error):
+            if invalid is None:
+                raise
+            invalid.append(upload)
+        upload.seek(0)
+    return files
+
+
+def extract_archive(upload):
+    """Return the files of the zip archive upload, or the upload itself if
+    it is a xlsx workbook
+
+    The files are spooled to temporary files, hidden files and folders are
+    left out.
+    """
+    archive = zipfile.ZipFile(upload)
+    names = archive.namelist()
+    if OOXML_CONTENT_TYPES in names:
+        return [upload]
+    files = []
+    for name in names:
+        filename = posixpath.basename(name)
+        if not filename or filename.startswith(".") or \
+                name.startswith("__MACOSX/"):
+            continue
+        spool = tempfile.SpooledTemporaryFile(SPOOL_THRESHOLD)
+        member = archive.open(name)
+        try:
+            shutil.copyfileobj(member, spool, SPOOL_CHUNK_SIZE)
+        finally:
+            member.close()
+        spool.seek(0)
+        files.append(FileUpload(FileStub(file=spool, name=filename)))
+    return files
+
+
+class MappedFile(object):
+    """Read-only file interface to a memory map
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.mapping.size() - self.mapping.tell()
+        return self.mapping.read(size)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            return self.mapping.readline()
+        return self.mapping.readline()[:size]
+
+    def seek(self, offset, whence=0):
+        self.mapping.seek(offset, whence)
+
+    def tell(self):
+        return self.mapping.tell()
+
+    def close(self):
+        self.mapping.close()
+
+
+def file_contents(infile):
+    """Return the contents of the file
+
+    Memory mapped files return their map, so the contents are not copied
+    into a string
+    """
+    if isinstance(infile, MappedFile):
+        return infile.mapping
+    return infile.read()
+
+
+def spool_upload(infile, threshold=None):
+    """Return a read-only memory mapped file of the upload if it is large
+
+    Uploads up to threshold bytes (SPOOL_THRESHOLD by default) are returned
+    as they are. Larger ones are mapped directly when they are backed by a
+    file on disk, otherwise they are copied in chunks to a temporary file,
+    which is mapped instead. It is up to the caller to close the returned
+    MappedFile.
+    """
+    threshold = SPOOL_THRESHOLD if threshold is None else threshold
+    infile.seek(0, 2)
+    size = infile.tell()
+    infile.seek(0)
+    if size <= threshold:
+        return infile
+
+    try:
+        mapping = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedFile(mapping)
+    except (AttributeError, EnvironmentError, ValueError):
+        # in-memory upload
+        pass
+
+    spool = tempfile.TemporaryFile()
+    try:
+        for chunk in iter(lambda: infile.read(SPOOL_CHUNK_SIZE), ""):
+            spool.write(chunk)
+        spool.flush()
+        # the map stays valid after the temporary file is closed
+        mapping = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedFile(mapping)
+    finally:
+        spool.close()
+        infile.seek(0)
+
+
+def content_hash(infile):
+    """Return the SHA1 hex digest of the file contents
+
+    The file is read in chunks and rewound afterwards
+    """
+    sha = hashlib.sha1()
+    infile.seek(0)
+    for chunk in iter(lambda: infile.read(SPOOL_CHUNK_SIZE), ""):
+        sha.update(chunk)
+    infile.seek(0)
+    return sha.hexdigest()
+
+
+class SheetCache(object):
+    """Bounded LRU cache of the rows read from spreadsheets
+
+    Entries are keyed by the hash of the file contents and the worksheet
+    selector, so uploading the same file again skips the decoding. Up to
+    max_rows rows of a sheet are kept in memory. With spill, the remaining
+    rows are pickled to a temporary file, otherwise larger sheets are not
+    cached at all.
+    """
+
+    def __init__(self, size=SHEET_CACHE_SIZE, max_rows=SHEET_CACHE_MAX_ROWS,
+                 spill=True):
+        self.size = size
+        self.max_rows = max_rows
+        self.spill = spill
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return an iterator over the cached rows or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            # mark as most recently used
+            self._entries[key] = entry
+            rows, path = entry
+            # open while locked, so the file can't be evicted in between
+            spilled = open(path, "rb") if path else None
+        return self._iter_entry(rows, spilled)
+
+    def _iter_entry(self, rows, spilled):
+        for row in rows:
+            yield row
+        if spilled is None:
+            return
+        try:
+            while True:
+                try:
+                    yield cPickle.load(spilled)
+                except EOFError:
+                    break
+        finally:
+            spilled.close()
+
+    def set(self, key, rows, path=None):
+        with self._lock:
+            self._discard(self._entries.pop(key, None))
+            self._entries[key] = (tuple(rows), path)
+            while len(self._entries) > self.size:
+                self._discard(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._discard(self._entries.popitem()[1])
+
+    def _discard(self, entry):
+        if entry and entry[1]:
+            try:
+                os.remove(entry[1])
+            except OSError:
+                pass
+
+    def caching_rows(self, key, rows):
+        """Generate the rows and store them once they are all consumed
+        """
+        cached = []
+        spill = None
+        complete = False
         try:
-            index = int(worksheet)
-            sheet = wb.worksheets[index]
-        except (ValueError, TypeError, IndexError):
-            raise SheetNotFound
+            for row in rows:
+                row = tuple(row)
+                if spill is not None:
+                    cPickle.dump(row, spill, cPickle.HIGHEST_PROTOCOL)
+                elif len(cached) < self.max_rows:
+                    cached.append(row)
+                elif self.spill:
+                    spill = tempfile.NamedTemporaryFile(
+                        prefix="senaite-sheet-", delete=False)
+                    cPickle.dump(row, spill, cPickle.HIGHEST_PROTOCOL)
+                else:
+                    # too large to be cached
+                    yield row
+                    for row in rows:
+                        yield row
+                    return
+                yield row
+            complete = True
+        finally:
+            if spill is not None:
+                spill.close()
+            if complete:
+                self.set(key, cached, spill and spill.name)
+            elif spill is not None:
+                os.remove(spill.name)
+
+
+sheet_cache = SheetCache()
+atexit.register(sheet_cache.clear)
 
+
+def closing_rows(rows, source):
+    """Generate the rows and close the source once they are consumed
+    """
+    try:
+        for row in rows:
+            yield row
+    finally:
+        if hasattr(rows, "close"):
+            rows.close()
+        source.close()
+
+
+def read_rows(infile, worksheet=None, delimiter=",", threshold=None,
+              cache=sheet_cache):
+    """Return an iterator over the rows of the file, whatever its format
+
+    The reader is chosen by sniffing the content, the file name extension
+    is not taken into account. Large uploads are memory mapped while the
+    rows are read, see spool_upload. Rows of xls and xlsx files are kept in
+    the cache, pass None to bypass it.
+    """
+    worksheet = worksheet if worksheet else 0
+    source = spool_upload(infile, threshold=threshold)
+    try:
+        file_format, encoding = sniff_format(source)
+        key = None
+        if cache is not None and file_format in ("xls", "xlsx"):
+            key = (content_hash(source), worksheet)
+            rows = cache.get(key)
+            if rows is not None:
+                if source is not infile:
+                    source.close()
+                return rows
+        if file_format == "xlsx":
+            rows = xlsx_rows(source, worksheet=worksheet)
+        elif file_format == "xls":
+            rows = xls_rows(source, worksheet=worksheet)
+        else:
+            rows = csv_rows(source, delimiter=delimiter, encoding=encoding)
+    except Exception:
+        if source is not infile:
+            source.close()
+        raise
+    if key is not None:
+        rows = cache.caching_rows(key, rows)
+    if source is infile:
+        return rows
+    return closing_rows(rows, source)
+
+
+def dict_rows(rows):
+    """Generate (row number, row dict) pairs keyed by the header row
+
+    The first non-empty row is taken as the header. Empty rows are skipped
+    and missing trailing cells are set to None, like csv.DictReader does.
+    Cell values are typed, see cell_value.
+    """
+    header = None
+    for row_nr, row in enumerate(rows, 1):
+        row = map(cell_value, row)
+        if not any(value is not None for value in row):
+            continue
+        if header is None:
+            header = map(cell_to_text, row)
+            continue
+        if len(row) < len(header):
+            row.extend([None] * (len(header) - len(row)))
+        yield row_nr, dict(zip(header, row))
+
+
+def xlsx_to_csv(infile, worksheet=None, delimiter=","):
     buffer = StringIO()
-    for row in sheet.rows:
-        line = []
-        for cell in row:
-            value = "" if cell.value is None else str(cell.value).encode("utf8")
-            if "\n" in value:  # fixme multi-line cell gives only first line
-                value = value.split("\n")[0]
-            line.append(value.strip())
+    for row in xlsx_rows(infile, worksheet=worksheet):
+        line = map(cell_to_text, row)
         if not any(line):
             continue
         buffer.write(delimiter.join(line) + "\n")
@@ -104,19 +612,17 @@ class InstrumentXLSResultsFileParser(InstrumentResultsFileParser):
         self._encoding = encoding
         self._end_header = False
 
+    def iterlines(self):
+        """Generate the lines of the converted file one at a time
+        """
+        return iter(self._csvfile.readline, "")
+
     def parse(self):
         infile = self._csvfile
         self.log("Parsing file ${file_name}",
                  mapping={"file_name": infile.filename})
         jump = 0
-        # We test in import functions if the file was uploaded
-        try:
-            name = getattr(infile, 'filename', getattr(infile, 'name'))
-            f = open(name, 'rU')
-        except AttributeError:
-            f = infile
-
-        for line in f.readlines():
+        for line in self.iterlines():
             self._numline += 1
             if jump == -1:
                 # Something went wrong. Finish
@@ -143,3 +649,202 @@ class InstrumentXLSResultsFileParser(InstrumentResultsFileParser):
                      "total_results": self.getResultsTotalCount()}
         )
         return True
+
+
+class TabularInstrumentParser(InstrumentResultsFileParser):
+    """Base parser for xls, xlsx or csv exports with a header row and the
+    results of one record per row
+
+    The rows are streamed from the upload, whatever its format, and passed
+    as dicts keyed by the header to parse_row, which subclasses implement.
+
+    The samples the rows reference are collected in a first pass, keeping
+    only their ids, and resolved with one catalog query before the rows are
+    parsed, see get_sample_id and get_ar. Rows of xls and xlsx files are
+    read once, the second pass is served by the sheet cache.
+
+    With diagnose, the outcome and the time of every row are recorded in
+    diagnostics, see dry_run.
+    """
+
+    def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
+        self.delimiter = delimiter if delimiter else ','
+        self.encoding = encoding
+        self.infile = infile
+        self.worksheet = worksheet if worksheet else 0
+        self._samples = {}
+        self._analyses = {}
+        # review states the samples and analyses are looked up in, all if
+        # None
+        self.sample_states = None
+        self.analysis_states = None
+        self.diagnose = False
+        self.diagnostics = []
+        self._row_results = None
+        self._rows = None
+        mimetype, encoding = guess_type(self.infile.filename)
+        InstrumentResultsFileParser.__init__(self, infile, mimetype)
+
+    def read_rows(self):
+        """Return an iterator over the (row number, row dict) pairs
+        """
+        if self._rows is not None:
+            return iter(self._rows)
+        rows = read_rows(self.infile,
+                         worksheet=self.worksheet,
+                         delimiter=self.delimiter)
+        return dict_rows(rows)
+
+    def preload_rows(self):
+        """Read all rows of the file at once, so they are not read again by
+        parse
+
+        No catalog or ZODB access is involved, S8TigerBulkParser preloads
+        its files in threads this way.
+        """
+        self._rows = list(self.read_rows())
+
+    def parse(self):
+        try:
+            sample_ids = self.get_sample_ids()
+            rows = self.read_rows()
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
+        except Exception:
+            # also raised by bugs of the get_sample_id(s) hooks
+            logger.exception("Can't parse {}".format(self.infile.filename))
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
+        self.prefetch_samples(sample_ids)
+        parse_row = self.diagnose_row if self.diagnose else self.parse_row
+        try:
+            for row_nr, row in rows:
+                parse_row(row_nr, row)
+        finally:
+            # the analyses change once the importer writes the results
+            self._analyses.clear()
+            self._rows = None
+        return 0
+
+    def parse_row(self, row_nr, row):
+        """Parse the row dict and add its results
+        """
+        raise NotImplementedError
+
+    def diagnose_row(self, row_nr, row):
+        """Parse the row dict, recording the sample and the keywords it
+        matched, the messages it caused and the time it took
+        """
+        counts = map(len, (self.errors, self.warns, self.logs))
+        self._row_results = []
+        start = time.time()
+        try:
+            self.parse_row(row_nr, row)
+        finally:
+            elapsed = time.time() - start
+            keywords = [kw for sid, kws in self._row_results for kw in kws]
+            self._row_results = None
+        sample_id = self.get_sample_id(row)
+        self.diagnostics.append({
+            "row": row_nr,
+            "sample_id": sample_id,
+            "sample_found": self._samples.get(sample_id) is not None,
+            "keywords": keywords,
+            "errors": self.errors[counts[0]:],
+            "warns": self.warns[counts[1]:],
+            "log": self.logs[counts[2]:],
+            "time_ms": round(elapsed * 1000, 3),
+        })
+
+    def _addRawResult(self, resid, values={}, override=False):
+        if self._row_results is not None:
+            self._row_results.append((resid, values.keys()))
+        InstrumentResultsFileParser._addRawResult(
+            self, resid, values, override)
+
+    def get_sample_id(self, row):
+        """Return the id of the sample the row dict refers to, if any
+        """
+        return None
+
+    def get_sample_ids(self):
+        """Return the ids of all samples referenced by the rows
+        """
+        sample_ids = set()
+        for row_nr, row in self.read_rows():
+            sample_id = self.get_sample_id(row)
+            if sample_id:
+                sample_ids.add(sample_id)
+        return sample_ids
+
+    def prefetch_samples(self, sample_ids):
+        """Resolve the samples not looked up yet, and their analyses, with a
+        single query each
+        """
+        missing = [sid for sid in sample_ids if sid not in self._samples]
+        if not missing:
+            return
+        samples = get_samples(missing, review_state=self.sample_states)
+        for sample_id in missing:
+            self._samples[sample_id] = samples.get(sample_id)
+        self._analyses.update(get_analyses_by_sample(
+            samples.keys(), review_state=self.analysis_states))
+
+    def use_samples(self, sample_ids, samples, analyses):
+        """Take the samples with the given ids and their analyses from the
+        results of get_samples and get_analyses_by_sample, looked up along
+        with the samples of other files
+        """
+        for sample_id in sample_ids:
+            self._samples[sample_id] = samples.get(sample_id)
+            if sample_id in analyses:
+                self._analyses[sample_id] = analyses[sample_id]
+
+    def get_ar(self, sample_id):
+        """Return the catalog brain of the sample with the given id, or None
+        """
+        self.prefetch_samples([sample_id])
+        return self._samples.get(sample_id)
+
+    def get_analyses(self, ar):
+        """Return a KeywordIndex of keyword -> analysis brain of the sample
+
+        The index is built once per sample and parse, from catalog metadata
+        only, usually along with the other samples in prefetch_samples.
+        """
+        sample_id = api.get_id(ar)
+        if sample_id not in self._analyses:
+            self._analyses.update(get_analyses_by_sample(
+                [sample_id], review_state=self.analysis_states))
+        return self._analyses[sample_id]
+
+
+def dry_run(importer):
+    """Parse the file of the importer's tabular parser and resolve its
+    samples and analyses, in the review states the importer takes into
+    account, without importing any results. Return the results dict of the
+    import, with the diagnostics of every row under "dry_run"
+
+    The transaction is doomed, so nothing done meanwhile can be committed.
+    """
+    transaction.doom()
+    parser = importer.getParser()
+    parser.sample_states = importer.getAllowedARStates()
+    parser.analysis_states = importer.getAllowedAnalysisStates()
+    parser.diagnose = True
+    start = time.time()
+    parser.parse()
+    parser.resume()
+    return {
+        "errors": parser.errors,
+        "log": parser.logs,
+        "warns": parser.warns,
+        "dry_run": {
+            "rows": parser.diagnostics,
+            "samples": parser.getObjectsTotalCount(),
+            "analyses": parser.getAnalysesTotalCount(),
+            "results": parser.getResultsTotalCount(),
+            "time_ms": round((time.time() - start) * 1000, 3),
+        },
+    }
@@ -1,4 +1,3 @@
-import csv
 import json
 import traceback
 from os.path import abspath
@@ -9,12 +8,15 @@ from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
 from senaite.core.exportimport.instruments.instrument import format_keyword
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from bika.lims.utils import t
-from cStringIO import StringIO
 from DateTime import DateTime
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from senaite.instruments.instrument import InstrumentXLSResultsFileParser
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
+from senaite.instruments.sequence import build_sequence
+from senaite.instruments.sequence import write_csv
+from senaite.instruments.utils import get_parent_uids
 from zope.component import getUtility
 from zope.interface import implements
 
@@ -30,7 +32,6 @@ class chemstationexport(object):
     def Export(self, context, request):
         tray = 1
         now = DateTime().strftime('%Y%m%d-%H%M')
-        uc = api.get_tool('uid_catalog')
         instrument = context.getInstrument()
         norm = getUtility(IIDNormalizer).normalize
         filename = '{}-{}.csv'.format(
@@ -44,52 +45,28 @@ class chemstationexport(object):
         for k, v in instrument.getDataInterfaceOptions():
             options[k] = v
 
-        # for looking up "cup" number (= slot) of ARs
-        parent_to_slot = {}
+        # one row per parent, in order of the "cup" number (= slot)
         layout = context.getLayout()
-        for x in range(len(layout)):
-            a_uid = layout[x]['analysis_uid']
-            p_uid = uc(UID=a_uid)[0].getObject().aq_parent.UID()
-            layout[x]['parent_uid'] = p_uid
-            if p_uid not in parent_to_slot.keys():
-                parent_to_slot[p_uid] = int(layout[x]['position'])
-
-        # write rows, one per PARENT
-        header = [listname, options['method']]
-        rows = []
-        rows.append(header)
-        tmprows = []
-        ARs_exported = []
-        for x in range(len(layout)):
-            # create batch header row
-            c_uid = layout[x]['container_uid']
-            p_uid = layout[x]['parent_uid']
-            if p_uid in ARs_exported:
-                continue
-            cup = parent_to_slot[p_uid]
-            tmprows.append([tray,
-                            cup,
-                            p_uid,
-                            c_uid,
-                            options['dilute_factor'],
-                            ""])
-            ARs_exported.append(p_uid)
-        tmprows.sort(lambda a, b: cmp(a[1], b[1]))
-        rows += tmprows
-
-        ramdisk = StringIO()
-        writer = csv.writer(ramdisk, delimiter=';')
-        assert(writer)
-        writer.writerows(rows)
-        result = ramdisk.getvalue()
-        ramdisk.close()
+        parent_uids = get_parent_uids(
+            [slot['analysis_uid'] for slot in layout])
+        sequence = build_sequence(
+            layout, lambda slot: parent_uids[slot['analysis_uid']])
+
+        def rows():
+            yield [listname, options['method']]
+            for cup, p_uid, slot in sequence:
+                yield [tray,
+                       cup,
+                       p_uid,
+                       slot['container_uid'],
+                       options['dilute_factor'],
+                       ""]
 
         # stream file to browser
         setheader = request.RESPONSE.setHeader
-        setheader('Content-Length', len(result))
         setheader('Content-Type', 'text/comma-separated-values')
         setheader('Content-Disposition', 'inline; filename=%s' % filename)
-        request.RESPONSE.write(result)
+        write_csv(request.RESPONSE, rows(), delimiter=';')
 
 
 class ChemStationParser(InstrumentXLSResultsFileParser):
@@ -192,6 +169,7 @@ class chemstationimport(object):
         self.context = context
         self.request = None
 
+    @async_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -231,7 +209,7 @@ class chemstationimport(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = ChunkedAnalysisResultsImporter(
                 parser=parser,
                 context=context,
                 allowed_ar_states=status,
@@ -249,5 +227,7 @@ class chemstationimport(object):
                 errors.append(tbex)
 
         results = {'errors': errors, 'log': logs, 'warns': warns}
+        if parser:
+            results['conflicts'] = importer.conflicts
 
         return json.dumps(results)
@@ -7,10 +7,11 @@ from bika.lims import bikaMessageFactory as _
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
 from senaite.core.exportimport.instruments.instrument import format_keyword
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from bika.lims.utils import t
 from DateTime import DateTime
 from senaite.instruments.instrument import InstrumentXLSResultsFileParser
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
 from zope.interface import implements
 
 
@@ -126,6 +127,7 @@ class aorcimport(object):
         self.context = context
         self.request = None
 
+    @async_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -165,7 +167,7 @@ class aorcimport(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = ChunkedAnalysisResultsImporter(
                 parser=parser,
                 context=context,
                 allowed_ar_states=status,
@@ -183,5 +185,7 @@ class aorcimport(object):
                 errors.append(tbex)
 
         results = {'errors': errors, 'log': logs, 'warns': warns}
+        if parser:
+            results['conflicts'] = importer.conflicts
 
         return json.dumps(results)
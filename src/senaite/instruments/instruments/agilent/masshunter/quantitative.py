@@ -9,12 +9,16 @@ from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
 from senaite.core.exportimport.instruments.instrument import format_keyword
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from senaite.core.exportimport.instruments.resultsimport import InstrumentCSVResultsFileParser
 from bika.lims.utils import t
 from DateTime import DateTime
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from senaite.app.supermodel.interfaces import ISuperModel
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
+from senaite.instruments.sequence import build_sequence
+from senaite.instruments.sequence import write_xml
+from senaite.instruments.utils import get_sample_titles
 from zope.component import getAdapter
 from zope.component import getUtility
 from zope.interface import implements
@@ -130,7 +134,7 @@ class QuantitativeParser(InstrumentCSVResultsFileParser):
         return
 
 
-class QuantitativeImporter(AnalysisResultsImporter):
+class QuantitativeImporter(ChunkedAnalysisResultsImporter):
     """ Importer
     """
 
@@ -144,6 +148,7 @@ class quantitativeimport(object):
         self.context = context
         self.request = None
 
+    @async_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -202,7 +207,8 @@ class quantitativeimport(object):
             tbex = traceback.format_exc()
             errors.append(tbex)
 
-        results = {'errors': errors, 'log': logs, 'warns': warns}
+        results = {'errors': errors, 'log': logs, 'warns': warns,
+                   'conflicts': importer.conflicts}
 
         return json.dumps(results)
 
@@ -223,72 +229,56 @@ class quantitativeexport(object):
             context.getId(), norm(self.title))
         now = str(DateTime())[:16]
 
-        root = ET.Element('SequenceTableDataSet')
-        root.set('SchemaVersion', "1.0")
-        root.set('SequenceComment', "")
-        root.set('SequenceOperator', "")
-        root.set('SequenceSeqPathFileName', "")
-        root.set('SequencePreSeqAcqCommand', "")
-        root.set('SequencePostSeqAcqCommand', "")
-        root.set('SequencePreSeqDACommand', "")
-        root.set('SequencePostSeqDACommand', "")
-        root.set('SequenceReProcessing', "False")
-        root.set('SequenceInjectBarCodeMismatch', "OnBarcodeMismatchInjectAnyway")
-        root.set('SequenceOverwriteExistingData', "False")
-        root.set('SequenceModifiedTimeStamp', now)
-        root.set('SequenceFileECMPath', "")
-
-        # for looking up "cup" number (= slot) of ARs
-        parent_to_slot = {}
+        attributes = [
+            ('SchemaVersion', "1.0"),
+            ('SequenceComment', ""),
+            ('SequenceOperator', ""),
+            ('SequenceSeqPathFileName', ""),
+            ('SequencePreSeqAcqCommand', ""),
+            ('SequencePostSeqAcqCommand', ""),
+            ('SequencePreSeqDACommand', ""),
+            ('SequencePostSeqDACommand', ""),
+            ('SequenceReProcessing', "False"),
+            ('SequenceInjectBarCodeMismatch', "OnBarcodeMismatchInjectAnyway"),
+            ('SequenceOverwriteExistingData', "False"),
+            ('SequenceModifiedTimeStamp', now),
+            ('SequenceFileECMPath', ""),
+        ]
+
+        # one sequence per parent, in order of the "cup" number (= slot)
         layout = context.getLayout()
-        for item in layout:
-            p_uid = item.get('parent_uid')
-            if not p_uid:
-                p_uid = item.get('container_uid')
-            if p_uid not in parent_to_slot.keys():
-                parent_to_slot[p_uid] = int(item['position'])
-
-        rows = []
-        sequences = []
-        for item in layout:
-            # create batch header row
-            p_uid = item.get('parent_uid')
-            if not p_uid:
-                p_uid = item.get('container_uid')
-            if not p_uid:
-                continue
-            if p_uid in sequences:
-                continue
-            sequences.append(p_uid)
-            cup = parent_to_slot[p_uid]
-            rows.append({
-                'tray': tray,
-                'cup': cup,
-                'analysis_uid': getAdapter(item['analysis_uid'], ISuperModel),
-                'sample': getAdapter(item['container_uid'], ISuperModel)
-            })
-        rows.sort(lambda a, b: cmp(a['cup'], b['cup']))
-
-        cnt = 0
-        for row in rows:
-            seq = ET.SubElement(root, 'Sequence')
-            ET.SubElement(seq, 'SequenceID').text = str(row['tray'])
-            ET.SubElement(seq, 'SampleID').text = str(cnt)
-            ET.SubElement(seq, 'AcqMethodFileName').text = 'Dunno'
-            ET.SubElement(seq, 'AcqMethodPathName').text = 'Dunno'
-            ET.SubElement(seq, 'DataFileName').text = row['sample'].Title()
-            ET.SubElement(seq, 'DataPathName').text = 'Dunno'
-            ET.SubElement(seq, 'SampleName').text = row['sample'].Title()
-            ET.SubElement(seq, 'SampleType').text = row['sample'].SampleType.Title()
-            ET.SubElement(seq, 'Vial').text = str(row['cup'])
-            cnt += 1
-
-        xml = ET.tostring(root, method='xml')
-        # stream file to browser
+        sequence = build_sequence(
+            layout,
+            lambda slot: slot.get('parent_uid') or slot.get('container_uid'))
+
+        # sample and sample type titles, for all samples at once
+        titles = get_sample_titles([item['container_uid'] for item in layout])
+
+        def sequences():
+            for cnt, (cup, p_uid, item) in enumerate(sequence):
+                c_uid = item['container_uid']
+                if c_uid in titles:
+                    title, sample_type = titles[c_uid]
+                else:
+                    sample = getAdapter(c_uid, ISuperModel)
+                    title = sample.Title()
+                    sample_type = sample.SampleType.Title()
+                seq = ET.Element('Sequence')
+                ET.SubElement(seq, 'SequenceID').text = str(tray)
+                ET.SubElement(seq, 'SampleID').text = str(cnt)
+                ET.SubElement(seq, 'AcqMethodFileName').text = 'Dunno'
+                ET.SubElement(seq, 'AcqMethodPathName').text = 'Dunno'
+                ET.SubElement(seq, 'DataFileName').text = title
+                ET.SubElement(seq, 'DataPathName').text = 'Dunno'
+                ET.SubElement(seq, 'SampleName').text = title
+                ET.SubElement(seq, 'SampleType').text = sample_type
+                ET.SubElement(seq, 'Vial').text = str(cup)
+                yield seq
+
+        # stream file to browser, one Sequence element at a time
         setheader = request.RESPONSE.setHeader
-        setheader('Content-Length', len(xml))
         setheader('Content-Disposition',
                   'attachment; filename="%s"' % filename)
         setheader('Content-Type', 'text/xml')
-        request.RESPONSE.write(xml)
-        request.RESPONSE.write(xml)
+        write_xml(request.RESPONSE, 'SequenceTableDataSet', attributes,
+                  sequences())
@@ -17,10 +17,12 @@
 #
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
-import csv
+import hashlib
 import json
 import traceback
-from mimetypes import guess_type
+from collections import OrderedDict
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 from os.path import abspath
 from os.path import basename
 from os.path import splitext
@@ -28,20 +30,25 @@ from re import subn
 
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
-from senaite.core.exportimport.instruments.resultsimport import \
-    AnalysisResultsImporter
+
 from senaite.core.exportimport.instruments.resultsimport import \
     InstrumentResultsFileParser
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.instruments.instrument import FileStub
-from senaite.instruments.instrument import SheetNotFound
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
+from senaite.instruments.instrument import TabularInstrumentParser
+from senaite.instruments.instrument import cell_to_text
+from senaite.instruments.instrument import content_hash
+from senaite.instruments.instrument import dry_run
+from senaite.instruments.instrument import expand_uploads
+from senaite.instruments.instrument import to_float
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
+from senaite.instruments.utils import get_analyses_by_sample
+from senaite.instruments.utils import get_samples
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
+
+# Number of threads reading the files of a bulk upload
+BULK_READ_THREADS = 4
 
 field_interim_map = {
     "Formula": "formula",
@@ -69,58 +76,36 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class S8TigerParser(InstrumentResultsFileParser):
+class S8TigerParser(TabularInstrumentParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None,
                  default_unit=None, delimiter=None):
-        self.delimiter = delimiter if delimiter else ','
+        TabularInstrumentParser.__init__(
+            self, infile, worksheet=worksheet, encoding=encoding,
+            delimiter=delimiter)
         self.unit = default_unit if default_unit else "pct"
-        self.encoding = encoding
         self.ar = None
         self.analyses = None
-        self.worksheet = worksheet if worksheet else 0
-        self.infile = infile
-        self.csv_data = None
         self.sample_id = None
-        mimetype = guess_type(self.infile.filename)
-        InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
-    def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == '.xlsx':
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == '.xls':
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == '.csv':
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter)
-                    break
-                except SheetNotFound:
-                    self.err("Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
+    def get_sample_candidates(self):
+        """Return the ids the sample of the file may have
+        """
+        sample_id, ext = splitext(basename(self.infile.filename))
+        # maybe the filename is a sample ID, just the way it is, or we
+        # need to chop of it's -9digit suffix
+        chopped = '-'.join(sample_id.split('-')[:-1])
+        return [sample_id, chopped]
 
+    def parse(self):
         try:
-            sample_id, ext = splitext(basename(self.infile.filename))
-            # maybe the filename is a sample ID, just the way it is
+            # look both candidates up at once
+            sample_id, chopped = self.get_sample_candidates()
+            self.prefetch_samples([sample_id, chopped])
             ar = self.get_ar(sample_id)
             if not ar:
-                # maybe we need to chop of it's -9digit suffix
-                sample_id = '-'.join(sample_id.split('-')[:-1])
+                sample_id = chopped
                 ar = self.get_ar(sample_id)
                 if not ar:
                     # or we are out of luck
@@ -133,24 +118,21 @@ class S8TigerParser(InstrumentResultsFileParser):
         except Exception as e:
             self.err(repr(e))
             return False
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        for row in reader:
-            self.parse_row(ar, reader.line_num, row)
-        return 0
+        return TabularInstrumentParser.parse(self)
 
-    def parse_row(self, ar, row_nr, row):
+    def parse_row(self, row_nr, row):
         # convert row to use interim field names
         if 'reading' not in field_interim_map.values():
             self.err("Missing 'reading' interim field.")
             return -1
-        parsed = {field_interim_map.get(k, ''): v for k, v in row.items()}
+        parsed = {field_interim_map.get(k, ''): '' if v is None else v
+                  for k, v in row.items()}
 
-        formula = parsed.get('formula')
+        formula = cell_to_text(parsed.get('formula'))
         kw = subn(r'[^\w\d\-_]*', '', formula)[0]
         kw = kw.lower()
         try:
-            analysis = self.get_analysis(ar, kw)
+            analysis = self.get_analysis(self.ar, kw)
             if not analysis:
                 return 0
             keyword = analysis.getKeyword
@@ -162,9 +144,11 @@ class S8TigerParser(InstrumentResultsFileParser):
 
         # Concentration can be PPM or PCT as it likes, I'll save both.
         concentration = parsed['concentration']
-        try:
-            val = float(subn(r'[^.\d]', '', str(concentration))[0])
-        except (TypeError, ValueError, IndexError):
+        val = to_float(concentration)
+        concentration = cell_to_text(concentration)
+        if val is None:
+            val = to_float(subn(r'[^.\d]', '', concentration)[0])
+        if val is None:
             self.warn(msg="Can't extract numerical value from `concentration`",
                       numline=row_nr, line=str(row))
             parsed['reading_pct'] = ''
@@ -192,23 +176,16 @@ class S8TigerParser(InstrumentResultsFileParser):
         self._addRawResult(self.sample_id, {keyword: parsed})
         return 0
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
+    def get_sample_id(self, row):
+        return self.sample_id
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_sample_ids(self):
+        # the sample is given by the file name and resolved in parse
+        return []
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k.startswith(kw)]
+        analyses = analyses.startswith(kw)
         if len(analyses) < 1:
             self.log('No analysis found matching keyword "${kw}"',
                      mapping=dict(kw=kw))
@@ -220,6 +197,118 @@ class S8TigerParser(InstrumentResultsFileParser):
         return analyses[0]
 
 
+def preload_rows(parser):
+    try:
+        parser.preload_rows()
+    except Exception:
+        # the file is read again, and the error reported, when parsed
+        pass
+
+
+class S8TigerBulkParser(InstrumentResultsFileParser):
+    """Parser for the files of many samples at once, e.g. of a whole tray
+
+    The files are read concurrently in a thread pool, while the samples of
+    all files and their analyses are looked up with one query each. The
+    rows are then parsed by a S8TigerParser per file, in this thread, and
+    their results and messages gathered here.
+    """
+
+    def __init__(self, uploads, worksheet=None, encoding=None,
+                 default_unit=None, delimiter=None, threads=None):
+        self.uploads = uploads
+        self.parsers = [S8TigerParser(upload,
+                                      worksheet=worksheet,
+                                      encoding=encoding,
+                                      default_unit=default_unit,
+                                      delimiter=delimiter)
+                        for upload in uploads]
+        self.threads = threads if threads else BULK_READ_THREADS
+        self.sample_states = None
+        self.analysis_states = None
+        self.diagnose = False
+        self.diagnostics = []
+        # sample id -> parser of the file its results were read from
+        self.sample_parsers = {}
+        infile = uploads[0] if uploads else None
+        InstrumentResultsFileParser.__init__(self, infile, None)
+
+    def parse(self):
+        if not self.parsers:
+            self.err("No results files found")
+            return False
+        candidates = dict((parser, parser.get_sample_candidates())
+                          for parser in self.parsers)
+        pool = ThreadPool(min(self.threads, len(self.parsers)))
+        try:
+            reading = pool.map_async(preload_rows, self.parsers)
+            samples = get_samples(chain.from_iterable(candidates.values()),
+                                  review_state=self.sample_states)
+            analyses = get_analyses_by_sample(
+                samples.keys(), review_state=self.analysis_states)
+            reading.wait()
+        finally:
+            pool.close()
+            pool.join()
+        for parser in self.parsers:
+            parser.use_samples(candidates[parser], samples, analyses)
+            parser.sample_states = self.sample_states
+            parser.analysis_states = self.analysis_states
+            parser.diagnose = self.diagnose
+            parser.parse()
+            self.gather(parser)
+        self.log("${count} files parsed",
+                 mapping={"count": str(len(self.parsers))})
+        return True
+
+    def gather(self, parser):
+        """Add the results, messages and diagnostics of a file's parser
+        """
+        filename = parser.infile.filename
+        for sample_id, results in parser.getRawResults().items():
+            for values in results:
+                self._addRawResult(sample_id, values)
+            self.sample_parsers[sample_id] = parser
+        for add, messages in ((self.err, parser.errors),
+                              (self.warn, parser.warns),
+                              (self.log, parser.logs)):
+            for message in messages:
+                add("${file_name}: ${message}",
+                    mapping={"file_name": filename, "message": message})
+        for diagnostic in parser.diagnostics:
+            diagnostic["file"] = filename
+            self.diagnostics.append(diagnostic)
+
+
+class S8TigerBulkImporter(ChunkedAnalysisResultsImporter):
+    """Importer of the results of a S8TigerBulkParser
+
+    The samples of a chunk are applied file by file, so that the file the
+    results of a sample were read from is the one attached to its analyses.
+    """
+
+    def get_checkpoint_key(self):
+        sha = hashlib.sha1()
+        for upload in self._parser.uploads:
+            sha.update(content_hash(upload))
+        return self.make_checkpoint_key(sha.hexdigest())
+
+    def process_chunk(self, parser, results):
+        by_parser = OrderedDict()
+        for sample_id in sorted(results):
+            file_results = by_parser.setdefault(
+                parser.sample_parsers[sample_id], {})
+            file_results[sample_id] = results[sample_id]
+        messages = ([], [], [])
+        for file_parser, file_results in by_parser.items():
+            ChunkedAnalysisResultsImporter.process_chunk(
+                self, file_parser, file_results)
+            for collected, new in zip(
+                    messages, (self._errors, self._warns, self._logs)):
+                collected.extend(new)
+        self._errors, self._warns, self._logs = messages
+
+
 class importer(object):
     implements(IInstrumentImportInterface, IInstrumentAutoImportInterface)
     title = "Bruker S8 Tiger"
@@ -230,25 +319,41 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @async_import
     def Import(context, request):
         errors = []
         logs = []
         warns = []
 
         infile = request.form['instrument_results_file']
-        if not hasattr(infile, 'filename'):
+        uploads = infile if isinstance(infile, list) else [infile]
+        if not all(hasattr(upload, 'filename') for upload in uploads):
             errors.append(_("No file selected"))
+            results = {'errors': errors, 'log': logs, 'warns': warns}
+            return json.dumps(results)
 
         artoapply = request.form['artoapply']
         override = request.form['results_override']
         instrument = request.form.get('instrument', None)
         default_unit = request.form['default_unit']
         worksheet = request.form.get('worksheet', 0)
-        parser = S8TigerParser(infile,
-                               worksheet=worksheet,
-                               default_unit=default_unit)
+        # many files, or a zip archive of them, are imported at once
+        invalid = []
+        files = expand_uploads(uploads, invalid=invalid)
+        if len(files) == 1:
+            parser = S8TigerParser(files[0],
+                                   worksheet=worksheet,
+                                   default_unit=default_unit)
+            importer_class = ChunkedAnalysisResultsImporter
+        else:
+            parser = S8TigerBulkParser(files,
+                                       worksheet=worksheet,
+                                       default_unit=default_unit)
+            importer_class = S8TigerBulkImporter
+        for upload in invalid:
+            parser.err("Cannot read the zip archive ${file_name}",
+                       mapping={"file_name": upload.filename})
         if parser:
-
             status = ['sample_received', 'attachment_due', 'to_be_verified']
             if artoapply == 'received':
                 status = ['sample_received']
@@ -263,7 +368,7 @@ class importer(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = importer_class(
                 parser=parser,
                 context=context,
                 allowed_ar_states=status,
@@ -271,6 +376,9 @@ class importer(object):
                 override=over,
                 instrument_uid=instrument)
 
+            if request.form.get('dry_run'):
+                return json.dumps(dry_run(importer))
+
             try:
                 importer.process()
                 errors = importer.errors
@@ -280,5 +388,7 @@ class importer(object):
                 errors.extend([repr(e), traceback.format_exc()])
 
         results = {'errors': errors, 'log': logs, 'warns': warns}
+        if parser:
+            results['conflicts'] = importer.conflicts
 
         return json.dumps(results)
@@ -17,30 +17,22 @@
 #
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
-import csv
 import json
 import traceback
-from mimetypes import guess_type
 from os.path import abspath
-from os.path import splitext
 from re import subn
 
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
-from senaite.core.exportimport.instruments.resultsimport import \
-    AnalysisResultsImporter
-from senaite.core.exportimport.instruments.resultsimport import \
-    InstrumentResultsFileParser
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.instruments.instrument import FileStub
-from senaite.instruments.instrument import SheetNotFound
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
+from senaite.instruments.instrument import TabularInstrumentParser
+from senaite.instruments.instrument import cell_to_text
+from senaite.instruments.instrument import dry_run
+from senaite.instruments.instrument import to_float
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 non_analyte_row_headers = [
     'Sample Id',
@@ -60,60 +52,21 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class Nexion350xParser(InstrumentResultsFileParser):
+class Nexion350xParser(TabularInstrumentParser):
     ar = None
 
     def __init__(self, infile, worksheet=0, encoding=None, delimiter=None):
-        self.delimiter = delimiter if delimiter else ','
-        self.encoding = encoding
-        self.infile = infile
-        self.worksheet = worksheet
-        self.csv_data = None
+        TabularInstrumentParser.__init__(
+            self, infile, worksheet=worksheet, encoding=encoding,
+            delimiter=delimiter)
         self.sample_id = None
-        mimetype, encoding = guess_type(self.infile.filename)
-        InstrumentResultsFileParser.__init__(self, infile, mimetype)
-
-    def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == '.xlsx':
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == '.xls':
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == '.csv':
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter)
-                    break
-                except SheetNotFound:
-                    self.err("Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        for row in reader:
-            self.parse_row(reader.line_num, row)
-        return 0
 
     def parse_row(self, row_nr, row):
-        if row['Sample Id'].lower().strip() in (
-                '', 'sample id', 'blk', 'rblk', 'calibration curves'):
+        sample_id = self.get_sample_id(row)
+        if not sample_id:
             return 0
 
         # Get sample for this row
-        sample_id = subn(r'[^\w\d\-_]*', '', row.get('Sample Id', ''))[0]
         ar = self.get_ar(sample_id)
         if not ar:
             msg = 'Sample not found for {}'.format(sample_id)
@@ -126,38 +79,32 @@ class Nexion350xParser(InstrumentResultsFileParser):
             kw = subn(r'[^\w\d]*', '', key)[0]
             if not kw:
                 continue
-            try:
-                brain = self.get_analysis(ar, kw, row_nr=row_nr, row=row)
-                if not brain:
-                    continue
-                new_kw = brain.getKeyword
-                parsed = dict(reading=float(row[key]), DefaultResult='reading')
-                self._addRawResult(sample_id, {new_kw: parsed})
-            except (TypeError, ValueError):
+            brain = self.get_analysis(ar, kw, row_nr=row_nr, row=row)
+            if not brain:
+                continue
+            reading = to_float(row[key])
+            if reading is None:
                 self.warn('Value for keyword ${kw} is not numeric',
                           mapping=dict(kw=kw),
                           numline=row_nr, line=str(row))
+                continue
+            new_kw = brain.getKeyword
+            parsed = dict(reading=reading, DefaultResult='reading')
+            self._addRawResult(sample_id, {new_kw: parsed})
 
         return 0
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type='AnalysisRequest', getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_sample_id(self, row):
+        sample_id = cell_to_text(row.get('Sample Id'))
+        if sample_id.lower() in (
+                '', 'sample id', 'blk', 'rblk', 'calibration curves'):
+            return None
+        return subn(r'[^\w\d\-_]*', '', sample_id)[0]
 
     def get_analysis(self, ar, kw, row_nr="", row=""):
         kw = kw
         items = self.get_analyses(ar)
-        brains = [v for k, v in items.items() if k.startswith(kw)]
+        brains = items.startswith(kw)
         if len(brains) < 1:
             return None
         if len(brains) > 1:
@@ -176,6 +123,7 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @async_import
     def Import(context, request):
         errors = []
         logs = []
@@ -192,7 +140,6 @@ class importer(object):
 
         parser = Nexion350xParser(infile, worksheet=worksheet)
         if parser:
-
             status = ['sample_received', 'attachment_due', 'to_be_verified']
             if artoapply == 'received':
                 status = ['sample_received']
@@ -207,7 +154,7 @@ class importer(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = ChunkedAnalysisResultsImporter(
                 parser=parser,
                 context=context,
                 allowed_ar_states=status,
@@ -215,6 +162,9 @@ class importer(object):
                 override=over,
                 instrument_uid=instrument)
 
+            if request.form.get('dry_run'):
+                return json.dumps(dry_run(importer))
+
             try:
                 importer.process()
                 errors = importer.errors
@@ -224,5 +174,7 @@ class importer(object):
                 errors.extend([repr(e), traceback.format_exc()])
 
         results = {'errors': errors, 'log': logs, 'warns': warns}
+        if parser:
+            results['conflicts'] = importer.conflicts
 
         return json.dumps(results)
@@ -17,30 +17,22 @@
 #
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
-import csv
 import json
 import traceback
-from mimetypes import guess_type
 from os.path import abspath
-from os.path import splitext
 from re import subn
 
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
-from senaite.core.exportimport.instruments.resultsimport import \
-    AnalysisResultsImporter
-from senaite.core.exportimport.instruments.resultsimport import \
-    InstrumentResultsFileParser
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.instruments.instrument import FileStub
-from senaite.instruments.instrument import SheetNotFound
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
+from senaite.instruments.instrument import TabularInstrumentParser
+from senaite.instruments.instrument import cell_to_text
+from senaite.instruments.instrument import dry_run
+from senaite.instruments.instrument import to_float
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 
 class MultipleAnalysesFound(Exception):
@@ -51,63 +43,23 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class Winlab32(InstrumentResultsFileParser):
+class Winlab32(TabularInstrumentParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
-        self.delimiter = delimiter if delimiter else ','
-        self.encoding = encoding
-        self.infile = infile
-        self.csv_data = None
-        self.worksheet = worksheet if worksheet else 0
+        TabularInstrumentParser.__init__(
+            self, infile, worksheet=worksheet, encoding=encoding,
+            delimiter=delimiter)
         self.sample_id = None
-        mimetype, encoding = guess_type(self.infile.filename)
-        InstrumentResultsFileParser.__init__(self, infile, mimetype)
-
-    def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == '.xlsx':
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == '.xls':
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == '.csv':
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter)
-                    break
-                except SheetNotFound:
-                    self.err("Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        for row in reader:
-            self.parse_row(reader.line_num, row)
-        return 0
 
     def parse_row(self, row_nr, row):
         # convert row to use interim field names
-        try:
-            value = float(row['Reported Conc (Calib)'])
-        except (TypeError, ValueError):
-            value = row['Reported Conc (Calib)']
+        value = row['Reported Conc (Calib)']
+        value = to_float(value, default=cell_to_text(value))
         parsed = {'reading': value, 'DefaultResult': 'reading'}
 
-        sample_id = subn(r'[^\w\d\-_]*', '', row.get('Sample ID', ""))[0]
-        kw = subn(r"[^\w\d]*", "", row.get('Analyte Name', ""))[0]
+        sample_id = self.get_sample_id(row)
+        kw = subn(r"[^\w\d]*", "", cell_to_text(row.get('Analyte Name')))[0]
         kw = kw
         if not sample_id or not kw:
             return 0
@@ -125,24 +77,14 @@ class Winlab32(InstrumentResultsFileParser):
         self._addRawResult(sample_id, {new_kw: parsed})
         return 0
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def get_analyses(ar):
-        brains = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in brains)
+    def get_sample_id(self, row):
+        sample_id = cell_to_text(row.get('Sample ID'))
+        return subn(r'[^\w\d\-_]*', '', sample_id)[0]
 
     def get_analysis(self, ar, kw):
         kw = kw
         brains = self.get_analyses(ar)
-        brains = [v for k, v in brains.items() if k.startswith(kw)]
+        brains = brains.startswith(kw)
         if len(brains) < 1:
             msg = "No analysis found matching Keyword '${kw}'",
             raise AnalysisNotFound(msg, kw=kw)
@@ -162,6 +104,7 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @async_import
     def Import(context, request):
         errors = []
         logs = []
@@ -178,7 +121,6 @@ class importer(object):
 
         parser = Winlab32(infile, worksheet=worksheet)
         if parser:
-
             status = ['sample_received', 'attachment_due', 'to_be_verified']
             if artoapply == 'received':
                 status = ['sample_received']
@@ -193,7 +135,7 @@ class importer(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = ChunkedAnalysisResultsImporter(
                 parser=parser,
                 context=context,
                 allowed_ar_states=status,
@@ -201,6 +143,9 @@ class importer(object):
                 override=over,
                 instrument_uid=instrument)
 
+            if request.form.get('dry_run'):
+                return json.dumps(dry_run(importer))
+
             try:
                 importer.process()
                 errors = importer.errors
@@ -210,5 +155,7 @@ class importer(object):
                 errors.extend([repr(e), traceback.format_exc()])
 
         results = {'errors': errors, 'log': logs, 'warns': warns}
+        if parser:
+            results['conflicts'] = importer.conflicts
 
         return json.dumps(results)
@@ -1,8 +1,7 @@
-import csv
 import json
 import re
 import traceback
-from cStringIO import StringIO
+from collections import OrderedDict
 from os.path import abspath
 
 from DateTime import DateTime
@@ -15,10 +14,17 @@ from senaite.core.exportimport.instruments.utils import \
     get_instrument_import_ar_allowed_states
 from senaite.core.exportimport.instruments.utils import \
     get_instrument_import_override
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from senaite.core.exportimport.instruments.resultsimport import \
     InstrumentCSVResultsFileParser
 from plone.i18n.normalizer.interfaces import IIDNormalizer
+from senaite.instruments.jobs import async_import
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
+from senaite.instruments.sequence import build_sequence
+from senaite.instruments.sequence import write_csv
+from senaite.instruments.utils import get_analyses_by_sample
+from senaite.instruments.utils import get_parent_uids
+from senaite.instruments.utils import get_service_keywords
+from senaite.instruments.utils import resolve_sample_ids
 from zope.component import getUtility
 from zope.interface import implements
 
@@ -35,7 +41,6 @@ class xcaliburexport(object):
     def Export(self, context, request):
         tray = 1
         now = DateTime().strftime('%Y%m%d-%H%M')
-        uc = api.get_tool('uid_catalog')
         instrument = context.getInstrument()
         norm = getUtility(IIDNormalizer).normalize
         filename = '{}-{}.csv'.format(
@@ -49,52 +54,28 @@ class xcaliburexport(object):
         for k, v in instrument.getDataInterfaceOptions():
             options[k] = v
 
-        # for looking up "cup" number (= slot) of ARs
-        parent_to_slot = {}
+        # one row per parent, in order of the "cup" number (= slot)
         layout = context.getLayout()
-        for x in range(len(layout)):
-            a_uid = layout[x]['analysis_uid']
-            p_uid = uc(UID=a_uid)[0].getObject().aq_parent.UID()
-            layout[x]['parent_uid'] = p_uid
-            if p_uid not in parent_to_slot.keys():
-                parent_to_slot[p_uid] = int(layout[x]['position'])
-
-        # write rows, one per PARENT
-        header = [listname, options['method']]
-        rows = []
-        rows.append(header)
-        tmprows = []
-        ARs_exported = []
-        for x in range(len(layout)):
-            # create batch header row
-            c_uid = layout[x]['container_uid']
-            p_uid = layout[x]['parent_uid']
-            if p_uid in ARs_exported:
-                continue
-            cup = parent_to_slot[p_uid]
-            tmprows.append([tray,
-                            cup,
-                            p_uid,
-                            c_uid,
-                            options['dilute_factor'],
-                            ""])
-            ARs_exported.append(p_uid)
-        tmprows.sort(lambda a, b: cmp(a[1], b[1]))
-        rows += tmprows
-
-        ramdisk = StringIO()
-        writer = csv.writer(ramdisk, delimiter=';')
-        assert(writer)
-        writer.writerows(rows)
-        result = ramdisk.getvalue()
-        ramdisk.close()
+        parent_uids = get_parent_uids(
+            [slot['analysis_uid'] for slot in layout])
+        sequence = build_sequence(
+            layout, lambda slot: parent_uids[slot['analysis_uid']])
+
+        def rows():
+            yield [listname, options['method']]
+            for cup, p_uid, slot in sequence:
+                yield [tray,
+                       cup,
+                       p_uid,
+                       slot['container_uid'],
+                       options['dilute_factor'],
+                       ""]
 
         # stream file to browser
         setheader = request.RESPONSE.setHeader
-        setheader('Content-Length', len(result))
         setheader('Content-Type', 'text/comma-separated-values')
         setheader('Content-Disposition', 'inline; filename=%s' % filename)
-        request.RESPONSE.write(result)
+        write_csv(request.RESPONSE, rows(), delimiter=';')
 
 
 class xcaliburimport(object):
@@ -106,6 +87,7 @@ class xcaliburimport(object):
         self.context = context
         self.request = None
 
+    @async_import
     def Import(self, context, request):
         """ Read Dimensional-CSV analysis results
         """
@@ -147,14 +129,14 @@ class xcaliburimport(object):
         if tbex:
             errors.append(tbex)
 
-        results = {'errors': errors, 'log': logs, 'warns': warns}
+        results = {'errors': errors, 'log': logs, 'warns': warns,
+                   'conflicts': importer.conflicts}
 
         return json.dumps(results)
 
 
 def is_keyword(kw):
-    bsc = api.get_tool('bika_setup_catalog')
-    return len(bsc(getKeyword=kw))
+    return kw in get_service_keywords()
 
 
 def find_analyses(ar_or_sample):
@@ -189,11 +171,7 @@ def find_analysis_interims(ar_or_sample):
         resultsimport.py or somewhere central where it can be used by other
         instrument interfaces.
     """
-    interim_fields = list()
-    for analysis in find_analyses(ar_or_sample):
-        keywords = get_interims_keywords(analysis)
-        interim_fields.extend(keywords)
-    return list(set(interim_fields))
+    return find_interim_owners(ar_or_sample).keys()
 
 
 def find_kw(ar_or_sample, kw):
@@ -204,10 +182,29 @@ def find_kw(ar_or_sample, kw):
         resultsimport.py or somewhere central where it can be used by other
         instrument interfaces.
     """
-    for analysis in find_analyses(ar_or_sample):
-        if kw in get_interims_keywords(analysis):
-            return analysis.getKeyword()
-    return None
+    return find_interim_owners(ar_or_sample).get(kw)
+
+
+def find_interim_owners(ar_or_sample):
+    """ Return a dict of interim field keyword -> keyword of the analysis
+        the interim field belongs to. The analysis with the first keyword
+        in alphabetical order wins when several share an interim field.
+    """
+    return interim_owners(find_analyses(ar_or_sample))
+
+
+def interim_owners(analyses):
+    """ Return a dict of interim field keyword -> analysis keyword for the
+        given analysis objects or brains, the first keyword in alphabetical
+        order winning, whatever the order of the analyses
+    """
+    owners = {}
+    keywords = [(api.safe_getattr(analysis, 'getKeyword'), analysis)
+                for analysis in analyses]
+    for keyword, analysis in sorted(keywords, key=lambda item: item[0]):
+        for interim in get_interims_keywords(analysis):
+            owners.setdefault(interim, keyword)
+    return owners
 
 
 class XCaliburCSVParser(InstrumentCSVResultsFileParser):
@@ -220,8 +217,63 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
         InstrumentCSVResultsFileParser.__init__(self, csv)
         self._end_header = False
         self._keywords = []
+        self._columns = []
         self._quantitationresultsheader = []
         self._numline = 0
+        self._interim_owners = {}
+
+    def parse(self):
+        sample_ids = self.get_interim_sample_ids()
+        if sample_ids:
+            self.prefetch_samples(sample_ids)
+        return InstrumentCSVResultsFileParser.parse(self)
+
+    def get_interim_sample_ids(self):
+        """ Return the sample or client sample ids of the result lines when
+            the header has interim columns, the owners of which have to be
+            looked up. Otherwise only the header lines are read
+        """
+        infile = self.getInputFile()
+        infile.seek(0)
+        sample_ids = set()
+        end_header = False
+        for line in iter(infile.readline, ''):
+            splitted = [token.strip() for token in line.split(',')]
+            if end_header:
+                if splitted[0] and splitted[0] != 'end':
+                    sample_ids.add(splitted[0])
+            elif splitted[-1] == 'end':
+                end_header = True
+                columns = self.compile_columns(splitted[1:-1])
+                if all(direct for kw, direct in columns):
+                    # no interim columns, no owners to look up
+                    break
+        infile.seek(0)
+        return sample_ids
+
+    def prefetch_samples(self, sample_ids):
+        """ Look up the interim field owners of all samples at once: the
+            samples are resolved with one query (falling back to client
+            sample ids), and the interim fields are read from the metadata
+            of their analysis brains, fetched with another one
+        """
+        resolved = resolve_sample_ids(sample_ids)
+        analyses = get_analyses_by_sample(resolved.values())
+        for ar_or_sample in sample_ids:
+            self._interim_owners[ar_or_sample] = {}
+        for ar_or_sample, sample_id in resolved.items():
+            brains = analyses[sample_id].values()
+            self._interim_owners[ar_or_sample] = interim_owners(brains)
+
+    def get_interim_owners(self, ar_or_sample):
+        """ Return the interim field owners of the sample, looked up once
+            per sample and file
+        """
+        owners = self._interim_owners.get(ar_or_sample)
+        if owners is None:
+            owners = find_interim_owners(ar_or_sample)
+            self._interim_owners[ar_or_sample] = owners
+        return owners
 
     def _parseline(self, line):
         if self._end_header:
@@ -241,9 +293,21 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
         splitted = [token.strip() for token in line.split(',')]
         if splitted[-1] == 'end':
             self._keywords = splitted[1:-1]  # exclude the word end
+            self._columns = self.compile_columns(self._keywords)
             self._end_header = True
         return 0
 
+    @staticmethod
+    def compile_columns(keywords):
+        """ Return the (keyword, is service keyword) pairs of the header
+            columns, with non-word characters removed from the keywords
+        """
+        columns = []
+        for keyword in keywords:
+            kw = re.sub(r"\W", "", keyword)
+            columns.append((kw, bool(is_keyword(kw))))
+        return columns
+
     def parse_resultsline(self, line):
         """ Parses result lines
         """
@@ -256,67 +320,44 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
         if len(blank_line) == 0:
             return 0
 
-        quantitation = {}
-        list_of_interim_results = []
-        # list_of_interim_results is a list that will have interim fields on
-        # the current line so that we don't have to call self._addRawResult
-        # for the same interim fields, ultimately we want a dict that looks
-        # like quantitation = {'AR': 'AP-0001-R01', 'interim1': 83.12, 'interim2': 22.3}
-        # self._addRawResult(quantitation['AR'],
-        #                    values={kw: quantitation},
-        #                    override=False)
-        # We use will one of the interims to find the analysis in this case new_kw which becomes kw
-        # kw is the analysis keyword which sometimes we have to find using the interim field
-        # because we have the result of the interim field and not of the analysis
-
-        found = False  # This is just a flag used to check values in list_of_interim_results
-        clean_splitted = splitted[1:-1]  # First value on the line is AR
-        for i in range(len(clean_splitted)):
-            token = clean_splitted[i]
-            if i < len(self._keywords):
-                quantitation['AR'] = splitted[0]
-                # quantitation['AN'] = self._keywords[i]
-                quantitation['DefaultResult'] = 'resultValue'
-                quantitation['resultValue'] = token
-            elif token:
+        ar = splitted[0]
+        tokens = splitted[1:-1]  # First value on the line is AR
+        columns = self._columns
+        for i in range(len(columns), len(tokens)):
+            if tokens[i]:
                 self.err("Orphan value in column ${index} (${token})",
                          mapping={"index": str(i + 1),
-                                  "token": token},
+                                  "token": tokens[i]},
                          numline=self._numline, line=line)
 
-            result = quantitation[quantitation['DefaultResult']]
-            column_name = quantitation['DefaultResult']
-            result = self.get_result(column_name, result, line)
-            quantitation[quantitation['DefaultResult']] = result
-
-            kw = re.sub(r"\W", "", self._keywords[i])
-            if not is_keyword(kw):
-                new_kw = find_kw(quantitation['AR'], kw)
-                if new_kw:
-                    quantitation[kw] = quantitation['resultValue']
-                    del quantitation['resultValue']
-                    for interim_res in list_of_interim_results:
-                        if kw in interim_res:
-                            # Interim field already in quantitation dict
-                            found = True
-                            break
-                    if found:
-                        continue
-                    interims = find_analysis_interims(quantitation['AR'])
-                    # pairing headers(keywords) and their values(results) per line
-                    keyword_value_dict = dict(zip(self._keywords, clean_splitted))
-                    for interim in interims:
-                        if interim in keyword_value_dict:
-                            quantitation[interim] = keyword_value_dict[interim]
-                            list_of_interim_results.append(quantitation)
-                    kw = new_kw
-                    kw = re.sub(r"\W", "", kw)
-
-            self._addRawResult(quantitation['AR'],
-                               values={kw: quantitation},
+        # Results of interim columns are gathered in one record per
+        # analysis they belong to, e.g.
+        # {'AR': 'AP-0001-R01', 'interim1': '83.12', 'interim2': '22.3'}
+        owners = None
+        records = OrderedDict()
+        for (kw, direct), token in zip(columns, tokens):
+            result = self.get_result('resultValue', token, line)
+            if not direct:
+                if owners is None:
+                    owners = self.get_interim_owners(ar)
+                analysis_kw = owners.get(kw)
+                if analysis_kw:
+                    record = records.get(analysis_kw)
+                    if record is None:
+                        record = {'AR': ar, 'DefaultResult': 'resultValue'}
+                        records[analysis_kw] = record
+                    record[kw] = token
+                    continue
+            quantitation = {'AR': ar,
+                            'DefaultResult': 'resultValue',
+                            'resultValue': result}
+            self._addRawResult(ar, values={kw: quantitation},
                                override=False)
-            quantitation = {}
-            found = False
+
+        for analysis_kw, record in records.items():
+            self._addRawResult(ar, values={analysis_kw: record},
+                               override=False)
+        return 0
 
     def get_result(self, column_name, result, line):
         result = str(result)
@@ -333,12 +374,11 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
         return
 
 
-class XCaliburImporter(AnalysisResultsImporter):
+class XCaliburImporter(ChunkedAnalysisResultsImporter):
 
     def __init__(self, parser, context, override,
                  allowed_ar_states=None, allowed_analysis_states=None,
                  instrument_uid='', form=None):
-        AnalysisResultsImporter.__init__(self, parser, context,
-                                         override, allowed_ar_states,
-                                         allowed_analysis_states,
-                                         instrument_uid)
+        ChunkedAnalysisResultsImporter.__init__(
+            self, parser, context, override, allowed_ar_states,
+            allowed_analysis_states, instrument_uid)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+
+"""Background import jobs
+
+Imports submitted with the async_import form field are not run within the
+request: the uploaded files are stored in temporary files and the import
+is queued for a worker thread, which runs it with its own ZODB connection
+as the submitting user. The request returns the job id at once, and
+@@instrument_import_status reports the progress and the final result.
+
+Jobs live in the memory of the Zope process which received the upload, so
+status requests must reach that same process (e.g. sticky load balancing).
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from functools import wraps
+from Queue import Queue
+
+import transaction
+import Zope2
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from bika.lims import api
+from senaite.instruments import logger
+from Testing.makerequest import makerequest
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+from zope.globalrequest import clearRequest
+from zope.globalrequest import setRequest
+from zope.publisher.browser import FileUpload
+
+# Form field requesting the import to run in the background
+ASYNC_IMPORT_FIELD = "async_import"
+
+# Seconds a finished job is kept for status requests
+JOB_EXPIRY = 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_queue = Queue()
+_worker = []
+_local = threading.local()
+
+
+class StoredFile(object):
+    """Field storage for an upload kept in a temporary file
+    """
+
+    def __init__(self, path, filename):
+        self.file = open(path, "rb")
+        self.filename = filename
+        self.headers = {}
+
+
+def is_upload(value):
+    return hasattr(value, "filename") and hasattr(value, "read")
+
+
+def store_upload(upload):
+    """Copy the upload into a temporary file, return its (filename, path)
+    """
+    upload.seek(0)
+    stored = tempfile.NamedTemporaryFile(
+        prefix="senaite-import-", delete=False)
+    with stored:
+        shutil.copyfileobj(upload, stored)
+    upload.seek(0)
+    return upload.filename, stored.name
+
+
+class ImportJob(object):
+    """An import queued with the form of its request
+    """
+
+    def __init__(self, func, context, request, adapter=None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.adapter = adapter
+        self.site_path = api.get_path(getSite())
+        self.context_path = api.get_path(context)
+        self.user_id = getSecurityManager().getUser().getId()
+        self.form = {}
+        # form field -> (list of (filename, path), whether a list was given)
+        self.uploads = {}
+        for key, value in request.form.items():
+            if key == ASYNC_IMPORT_FIELD:
+                continue
+            is_list = isinstance(value, (list, tuple))
+            values = value if is_list else [value]
+            if values and all(map(is_upload, values)):
+                self.uploads[key] = (map(store_upload, values), is_list)
+            else:
+                self.form[key] = value
+        self.state = QUEUED
+        self.progress = None
+        self.result = None
+        self.finished = None
+
+    def get_form(self):
+        """Return the form of the job, with the stored uploads
+        """
+        form = dict(self.form)
+        for key, (files, is_list) in self.uploads.items():
+            uploads = [FileUpload(StoredFile(path, filename))
+                       for filename, path in files]
+            form[key] = uploads if is_list else uploads[0]
+        return form
+
+    def cleanup(self):
+        for files, is_list in self.uploads.values():
+            for filename, path in files:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def finish(self, state, result):
+        self.state = state
+        self.result = result
+        self.finished = time.time()
+
+    def to_dict(self):
+        data = {
+            "job_id": self.id,
+            "state": self.state,
+            "progress": self.progress,
+        }
+        data.update(self.result or {"errors": [], "log": [], "warns": []})
+        return data
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def in_job():
+    """Return whether the code runs within a background import job
+    """
+    return getattr(_local, "job", None) is not None
+
+
+def update_progress(done, total=None):
+    """Report the progress of the running import job
+
+    Does nothing when the import does not run as a background job.
+    """
+    job = getattr(_local, "job", None)
+    if job is not None:
+        job.progress = {"done": done, "total": total}
+
+
+def queue_import(func, context, request, adapter=None):
+    """Queue the import func as a background job, return the JSON response
+    """
+    job = ImportJob(func, context, request, adapter=adapter)
+    with _jobs_lock:
+        now = time.time()
+        for old in _jobs.values():
+            if old.finished and now - old.finished > JOB_EXPIRY:
+                del _jobs[old.id]
+        _jobs[job.id] = job
+        if not _worker:
+            worker = threading.Thread(
+                name="senaite.instruments import", target=work)
+            worker.setDaemon(True)
+            worker.start()
+            _worker.append(worker)
+    _queue.put(job)
+    url = "{}/@@instrument_import_status?job_id={}".format(
+        api.get_url(api.get_portal()), job.id)
+    return json.dumps({
+        "errors": [],
+        "log": ["Import queued, follow its progress at {}".format(url)],
+        "warns": [],
+        "job_id": job.id,
+        "status_url": url,
+    })
+
+
+def async_import(func):
+    """Decorator for the Import methods of the import adapters, queueing the
+    import as a background job when the form asks for it
+    """
+    @wraps(func)
+    def Import(*args):
+        context, request = args[-2:]
+        if not request.form.get(ASYNC_IMPORT_FIELD):
+            return func(*args)
+        adapter = type(args[0]) if len(args) > 2 else None
+        return queue_import(func, context, request, adapter=adapter)
+    return Import
+
+
+def work():
+    while True:
+        job = _queue.get()
+        try:
+            run_job(job)
+        except Exception:
+            logger.error("Import job {} failed: {}".format(
+                job.id, traceback.format_exc()))
+
+
+def get_user(app, site, user_id):
+    for acl_users in (site.acl_users, app.acl_users):
+        user = acl_users.getUserById(user_id)
+        if user is not None:
+            return user.__of__(acl_users)
+    raise KeyError("User not found: {}".format(user_id))
+
+
+def run_job(job):
+    """Run the import of the job with its own connection, as the user who
+    submitted it
+    """
+    app = makerequest(Zope2.app())
+    _local.job = job
+    job.state = RUNNING
+    form = {}
+    try:
+        site = app.unrestrictedTraverse(job.site_path)
+        setSite(site)
+        newSecurityManager(app.REQUEST, get_user(app, site, job.user_id))
+        # api.get_request and the translations look up the global request
+        setRequest(app.REQUEST)
+        context = app.unrestrictedTraverse(job.context_path)
+        request = app.REQUEST
+        form = job.get_form()
+        request.form.update(form)
+        args = (context, request)
+        if job.adapter is not None:
+            args = (job.adapter(context), ) + args
+        result = json.loads(job.func(*args))
+        if transaction.isDoomed():
+            # dry runs doom the transaction
+            transaction.abort()
+        else:
+            transaction.commit()
+        job.finish(DONE, result)
+    except Exception:
+        transaction.abort()
+        job.finish(FAILED, {"errors": [traceback.format_exc()],
+                            "log": [],
+                            "warns": []})
+    finally:
+        _local.job = None
+        for value in form.values():
+            for upload in value if isinstance(value, list) else [value]:
+                if isinstance(upload, FileUpload):
+                    upload.close()
+        job.cleanup()
+        noSecurityManager()
+        clearRequest()
+        setSite(None)
+        app._p_jar.close()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+
+import hashlib
+import random
+import time
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from bika.lims import api
+from senaite.core.exportimport.instruments.resultsimport import \
+    AnalysisResultsImporter
+from senaite.core.exportimport.instruments.resultsimport import \
+    InstrumentResultsFileParser
+from senaite.instruments.instrument import content_hash
+from senaite.instruments.jobs import in_job
+from senaite.instruments.jobs import update_progress
+from zope.annotation.interfaces import IAnnotations
+from ZODB.POSException import ConflictError
+
+# Number of samples whose results are applied at once
+IMPORT_CHUNK_SIZE = 50
+
+# Portal annotation holding the samples done by interrupted imports
+CHECKPOINTS_KEY = "senaite.instruments.import_checkpoints"
+
+# Days the samples done by an interrupted import are remembered
+CHECKPOINT_DAYS = 7
+
+# Form field asking to import all samples of the file again
+RESTART_IMPORT_FIELD = "restart_import"
+
+# Times the results of samples are applied again after a ConflictError
+CONFLICT_RETRIES = 3
+
+# Seconds to wait before the first retry, doubled for every further retry
+CONFLICT_BACKOFF = 0.2
+CONFLICT_BACKOFF_MAX = 2.0
+
+# Summary logged by AnalysisResultsImporter for every chunk, logged once with
+# the totals of all chunks instead
+IMPORT_FINISHED = "Import finished successfully"
+
+
+def get_checkpoints():
+    """Return the mapping of import key -> (time of the last commit, ids of
+    the samples already imported and committed)
+    """
+    annotations = IAnnotations(api.get_portal())
+    checkpoints = annotations.get(CHECKPOINTS_KEY)
+    if checkpoints is None:
+        checkpoints = OOBTree()
+        annotations[CHECKPOINTS_KEY] = checkpoints
+    return checkpoints
+
+
+def get_checkpoint(key):
+    """Return the ids of the samples imported before by the import with key
+    """
+    checkpoint = get_checkpoints().get(key)
+    return checkpoint[1] if checkpoint is not None else ()
+
+
+def set_checkpoint(key, objids):
+    """Record the ids of the samples imported by the import with key
+    """
+    get_checkpoints()[key] = (time.time(), tuple(objids))
+
+
+def purge_checkpoints():
+    """Remove the checkpoints not updated for CHECKPOINT_DAYS
+    """
+    checkpoints = get_checkpoints()
+    expired = time.time() - CHECKPOINT_DAYS * 24 * 3600
+    for key, (timestamp, objids) in list(checkpoints.items()):
+        if timestamp < expired:
+            del checkpoints[key]
+
+
+def add_counts(totals, counts):
+    """Add the counts, e.g. the mapping of an import summary, to totals
+    """
+    for name, count in counts.items():
+        totals[name] = totals.get(name, 0) + int(count)
+
+
+def conflict_backoff(attempt):
+    """Return the seconds to wait before the retry after attempt conflicts
+    """
+    delay = min(CONFLICT_BACKOFF * 2 ** (attempt - 1), CONFLICT_BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+class ChunkParser(InstrumentResultsFileParser):
+    """Presents the raw results of some samples of a parsed file to the
+    importer, as if they were all the file contained
+    """
+
+    def __init__(self, parser, results):
+        InstrumentResultsFileParser.__init__(
+            self, parser.getInputFile(), parser.getFileMimeType())
+        self._parser = parser
+        self._header = parser.getHeader()
+        self._rawresults = results
+
+    def parse(self):
+        return True
+
+    def getAttachmentFileType(self):
+        return self._parser.getAttachmentFileType()
+
+
+class ChunkedAnalysisResultsImporter(AnalysisResultsImporter):
+    """Applies the parsed results in chunks of chunk_size samples
+
+    Before every chunk a savepoint is made, so the objects modified by the
+    chunks before do not need to be held in memory until the end. With
+    commit, every chunk is committed instead, and the ids of its samples
+    are recorded in a checkpoint, so an import of the same file with the
+    same options interrupted by an error resumes with the samples not
+    imported yet. Checkpoints are dropped after CHECKPOINT_DAYS, and with
+    restart, or the restart_import form field, all samples are imported
+    again. Imports running as background jobs commit by default.
+    The import finished summary is logged once, with the totals of all
+    chunks.
+
+    When committing, a chunk failing with a ConflictError is aborted and
+    applied again after a jittered backoff. If it keeps failing, its
+    samples are applied one by one the same way, so only the samples in
+    conflict are left out. The number of conflicts and retries and the
+    samples left out are kept in conflicts. Without commit, conflicts only
+    show when the request commits, so they are left to the publisher,
+    which retries the whole request.
+    """
+
+    def __init__(self, parser, context,
+                 override=[False, False],
+                 allowed_ar_states=None,
+                 allowed_analysis_states=None,
+                 instrument_uid=None,
+                 chunk_size=None,
+                 commit=None,
+                 restart=None):
+        AnalysisResultsImporter.__init__(
+            self, parser, context, override, allowed_ar_states,
+            allowed_analysis_states, instrument_uid)
+        self.chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+        self.commit = in_job() if commit is None else commit
+        if restart is None:
+            request = api.get_request()
+            restart = request is not None and bool(
+                request.form.get(RESTART_IMPORT_FIELD))
+        self.restart = restart
+        self.conflicts = {"count": 0, "retries": 0, "failed": []}
+        # (message, totals) of the import finished summaries of the chunks
+        self._summary = None
+        self._chunk_summary = None
+
+    def get_checkpoint_key(self):
+        """Return the key of the checkpoint of an import of the file
+        """
+        return self.make_checkpoint_key(
+            content_hash(self._parser.getInputFile()))
+
+    def make_checkpoint_key(self, file_hash):
+        """Return the key of the checkpoint of an import of the file with
+        file_hash into the context, with the override and allowed states
+        of this importer
+        """
+        options = repr((list(self.getOverride()),
+                        sorted(self.getAllowedARStates()),
+                        sorted(self.getAllowedAnalysisStates())))
+        return "{}:{}:{}".format(api.get_path(self.context), file_hash,
+                                 hashlib.sha1(options).hexdigest())
+
+    def log(self, msg, numline=None, line=None, mapping={}):
+        if msg.startswith(IMPORT_FINISHED) and self._summary is not None:
+            # logged once with the totals of all chunks
+            totals = {}
+            if self._chunk_summary is not None:
+                totals = self._chunk_summary[1]
+            add_counts(totals, mapping)
+            self._chunk_summary = (msg, totals)
+            return
+        AnalysisResultsImporter.log(
+            self, msg, numline=numline, line=line, mapping=mapping)
+
+    def add_chunk_summary(self):
+        """Add the counts of the summary of the last chunk to the totals
+        """
+        if self._chunk_summary is None:
+            return
+        msg, counts = self._chunk_summary
+        totals = self._summary[1]
+        add_counts(totals, counts)
+        self._summary = (msg, totals)
+        self._chunk_summary = None
+
+    def process(self):
+        parser = self._parser
+        parser.parse()
+        parsed = parser.resume()
+        self._errors = parser.errors
+        self._warns = parser.warns
+        self._logs = parser.logs
+        if parsed is False:
+            return False
+
+        results = parser.getRawResults()
+        done = set()
+        key = None
+        if self.commit:
+            key = self.get_checkpoint_key()
+            purge_checkpoints()
+            if self.restart and key in get_checkpoints():
+                del get_checkpoints()[key]
+            done.update(get_checkpoint(key))
+            if done:
+                self.log("Resuming import, ${count} samples were imported "
+                         "before. Check \"Import all samples again\" to "
+                         "start over, the samples imported are forgotten "
+                         "after ${days} days",
+                         mapping={"count": str(len(done)),
+                                  "days": str(CHECKPOINT_DAYS)})
+        pending = [objid for objid in sorted(results) if objid not in done]
+        messages = (list(self._errors), list(self._warns), list(self._logs))
+        self._summary = (None, {})
+
+        for start in range(0, len(pending), self.chunk_size):
+            chunk = pending[start:start + self.chunk_size]
+            if not self.apply(chunk, results, messages, key, done):
+                # apply the samples one by one, so the samples in conflict
+                # do not hold back the others
+                for objid in chunk:
+                    if len(chunk) == 1 or not self.apply(
+                            [objid], results, messages, key, done):
+                        self.conflicts["failed"].append(objid)
+            update_progress(start + len(chunk), len(pending))
+
+        # the samples left out are imported when the file is imported again
+        if key is not None and not self.conflicts["failed"] and \
+                key in get_checkpoints():
+            del get_checkpoints()[key]
+        self._errors, self._warns, self._logs = messages
+        msg, totals = self._summary
+        self._summary = None
+        if msg is not None:
+            self.log(msg, mapping=dict(
+                (name, str(total)) for name, total in totals.items()))
+        for objid in self.conflicts["failed"]:
+            self.err("Results of ${sample_id} not imported because of "
+                     "conflicting changes, please import the file again",
+                     mapping={"sample_id": objid})
+        self.log("${count} samples processed in chunks of ${size}",
+                 mapping={"count": str(len(pending)),
+                          "size": str(self.chunk_size)})
+        return True
+
+    def apply(self, objids, results, messages, key, done):
+        """Apply the results of the samples with objids as one unit, retried
+        on conflicts when committing. Return whether the unit was applied
+        """
+        parser = self._parser
+        for attempt in range(CONFLICT_RETRIES + 1):
+            if attempt:
+                self.conflicts["retries"] += 1
+                time.sleep(conflict_backoff(attempt))
+            self._chunk_summary = None
+            if not self.commit:
+                transaction.savepoint(optimistic=True)
+            try:
+                self.process_chunk(
+                    parser, dict((objid, results[objid]) for objid in objids))
+                if self.commit:
+                    set_checkpoint(key, done.union(objids))
+                    transaction.commit()
+            except ConflictError:
+                if not self.commit:
+                    raise
+                self.conflicts["count"] += 1
+                transaction.abort()
+                continue
+            finally:
+                self._parser = parser
+            done.update(objids)
+            self.add_chunk_summary()
+            self.collect_messages(messages)
+            return True
+        return False
+
+    def process_chunk(self, parser, results):
+        """Apply the results of some samples of the parser
+        """
+        self._parser = self.get_chunk_parser(parser, results)
+        AnalysisResultsImporter.process(self)
+
+    def get_chunk_parser(self, parser, results):
+        """Return the parser presenting the results of a chunk
+        """
+        return ChunkParser(parser, results)
+
+    def collect_messages(self, messages):
+        """Add the messages of the last chunk to the ones of the import,
+        leaving out those repeated by every chunk
+        """
+        chunk_messages = (self._errors, self._warns, self._logs)
+        for collected, new in zip(messages, chunk_messages):
+            seen = set(collected)
+            for message in new:
+                if message not in seen:
+                    collected.append(message)
+                    seen.add(message)
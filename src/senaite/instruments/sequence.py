@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+
+import csv
+import xml.etree.cElementTree as ET
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+# Size (in bytes) of the chunks written to the response
+SEQUENCE_CHUNK_SIZE = 64 * 1024
+
+
+def build_sequence(layout, get_parent):
+    """Return the sequence of a worksheet layout, one entry per parent
+
+    get_parent returns the parent uid of a layout slot; slots without parent
+    are skipped. Each entry is a (position, parent uid, slot) tuple of the
+    first slot of the parent, and the entries are ordered by position.
+    """
+    first_slots = OrderedDict()
+    for slot in layout:
+        parent = get_parent(slot)
+        if parent and parent not in first_slots:
+            first_slots[parent] = slot
+    sequence = [(int(slot['position']), p_uid, slot)
+                for p_uid, slot in first_slots.items()]
+    sequence.sort(key=lambda entry: entry[0])
+    return sequence
+
+
+def xml_start_tag(tag, attributes):
+    """Return the start tag of an element with the given attributes, in the
+    form ElementTree serializes it (attributes sorted by name)
+    """
+    attrs = "".join(
+        ' %s="%s"' % (name, escape(value, {'"': "&quot;", "\n": "&#10;"}))
+        for name, value in sorted(attributes))
+    return "<%s%s>" % (tag, attrs)
+
+
+class ChunkedWriter(object):
+    """Buffers the written strings and passes them on to the response in
+    chunks of about chunk_size bytes
+    """
+
+    def __init__(self, response, chunk_size=None):
+        self.response = response
+        self.chunk_size = chunk_size or SEQUENCE_CHUNK_SIZE
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.response.write("".join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+
+def write_xml(response, tag, attributes, elements, chunk_size=None):
+    """Stream an xml document to the response
+
+    The root element has the given tag and (name, value) attributes, and
+    holds the ElementTree elements of the given iterable, which are
+    serialized one at a time as they are produced.
+    """
+    writer = ChunkedWriter(response, chunk_size=chunk_size)
+    writer.write(xml_start_tag(tag, attributes))
+    for element in elements:
+        writer.write(ET.tostring(element))
+    writer.write("</%s>" % tag)
+    writer.flush()
+
+
+def write_csv(response, rows, delimiter=",", chunk_size=None):
+    """Stream the rows of the given iterable to the response as csv
+    """
+    writer = ChunkedWriter(response, chunk_size=chunk_size)
+    csv.writer(writer, delimiter=delimiter).writerows(rows)
+    writer.flush()
@@ -19,6 +19,8 @@
 # Some rights reserved, see README and LICENSE.
 
 import cStringIO
+import json
+import zipfile
 from datetime import datetime
 from os.path import abspath
 from os.path import dirname
@@ -188,6 +190,79 @@ class TestBrukerS8Tiger(BaseTestCase):
         self.assertEqual(ag.getResult(), '1118000.0')
         self.assertEqual(al.getResult(), '2228000.0')
 
+    def add_sample(self):
+        ar = self.add_analysisrequest(
+            self.client,
+            dict(Client=self.client.UID(),
+                 Contact=self.contact.UID(),
+                 DateSampled=datetime.now().date().isoformat(),
+                 SampleType=self.sampletype.UID()),
+            [srv.UID() for srv in self.services])
+        api.do_transition_for(ar, 'receive')
+        return ar
+
+    def import_files(self, import_files):
+        request = TestRequest(form=dict(
+            submitted=True,
+            artoapply='received_tobeverified',
+            results_override='override',
+            instrument_results_file=import_files,
+            default_unit='pct',
+            instrument=''))
+        return json.loads(importer.Import(self.portal, request))
+
+    def assertResults(self, ar):
+        ag = ar.getAnalyses(full_objects=True, getKeyword='ag107')[0]
+        al = ar.getAnalyses(full_objects=True, getKeyword='al27')[0]
+        self.assertEqual(ag.getResult(), '111.8')
+        self.assertEqual(al.getResult(), '222.8')
+
+    def test_import_several_files(self):
+        ar1 = self.add_sample()
+        ar2 = self.add_sample()
+        xlsx = open(fn1, 'rb').read()
+        csv = open(fn2, 'rb').read()
+        results = self.import_files([
+            FileUpload(TestFile(cStringIO.StringIO(xlsx),
+                                ar1.getId() + '-234987347.xlsx')),
+            FileUpload(TestFile(cStringIO.StringIO(csv),
+                                ar2.getId() + '.csv'))])
+        self.assertResults(ar1)
+        self.assertResults(ar2)
+        self.assertIn('2 files parsed', results['log'])
+
+    def test_import_zip(self):
+        ar1 = self.add_sample()
+        ar2 = self.add_sample()
+        archive = cStringIO.StringIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('tray/' + ar1.getId() + '-234987347.xlsx',
+                        open(fn1, 'rb').read())
+            zf.writestr('tray/' + ar2.getId() + '.csv',
+                        open(fn2, 'rb').read())
+        archive.seek(0)
+        results = self.import_files(
+            FileUpload(TestFile(archive, 'tray.zip')))
+        self.assertResults(ar1)
+        self.assertResults(ar2)
+        self.assertIn('2 files parsed', results['log'])
+
+    def test_import_bad_file_among_good_ones(self):
+        ar = self.add_sample()
+        csv = open(fn2, 'rb').read()
+        results = self.import_files([
+            FileUpload(TestFile(cStringIO.StringIO('PK\x03\x04broken'),
+                                'broken.zip')),
+            FileUpload(TestFile(cStringIO.StringIO(csv),
+                                ar.getId() + '.csv')),
+            FileUpload(TestFile(cStringIO.StringIO(csv), 'XX-0001.csv'))])
+        self.assertResults(ar)
+        self.assertIn('Cannot read the zip archive broken.zip',
+                      results['errors'])
+        # the messages of the files are prefixed with their names
+        self.assertIn("XX-0001.csv: Can't find sample for XX-0001.csv",
+                      results['warns'])
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+import codecs
+import cStringIO
+import re
+import zipfile
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+
+import unittest2 as unittest
+from openpyxl import Workbook
+
+from senaite.instruments import instrument
+from senaite.instruments.instrument import SheetCache
+from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import TabularInstrumentParser
+from senaite.instruments.instrument import UnsupportedFormat
+from senaite.instruments.instrument import dict_rows
+from senaite.instruments.instrument import expand_uploads
+from senaite.instruments.instrument import read_rows
+from senaite.instruments.instrument import sniff_format
+from senaite.instruments.tests import TestFile
+from zope.publisher.browser import FileUpload
+
+here = abspath(dirname(__file__))
+path = join(here, 'files', 'instruments')
+xls_fn = join(path, 'agilent.chemstation.chemstation.xls')
+xlsx_fn = join(path, 'bruker', 's8tiger', 'DU-0001-234987347.xlsx')
+csv_fn = join(path, 'perkinelmer', 'winlab32', 'winlab32.csv')
+
+
+def upload(data, filename='upload'):
+    return FileUpload(TestFile(cStringIO.StringIO(data), filename))
+
+
+class TestRowSources(unittest.TestCase):
+
+    def test_sniff_format(self):
+        self.assertEqual(
+            sniff_format(upload(open(xlsx_fn, 'rb').read())), ('xlsx', None))
+        self.assertEqual(
+            sniff_format(upload(open(xls_fn, 'rb').read())), ('xls', None))
+        self.assertEqual(
+            sniff_format(upload(open(csv_fn, 'rb').read())), ('csv', None))
+        self.assertRaises(
+            UnsupportedFormat, sniff_format, upload('\x00\x01\x02'))
+
+    def test_format_does_not_depend_on_filename(self):
+        infile = upload(open(xlsx_fn, 'rb').read(), filename='DU-0001.csv')
+        rows = list(dict_rows(read_rows(infile)))
+        row_nr, row = rows[0]
+        self.assertEqual(row['Formula'], 'Ag 107')
+        self.assertEqual(row['Z'], 26)
+        self.assertEqual(row['Bound %'], None)
+
+    def test_xlsx_with_wrong_dimension(self):
+        wb = Workbook()
+        for nr in range(6):
+            wb.active.append(['a%s' % nr, 'b%s' % nr, nr])
+        data = cStringIO.StringIO()
+        wb.save(data)
+        # store a dimension which covers the first two rows only
+        source = zipfile.ZipFile(cStringIO.StringIO(data.getvalue()))
+        data = cStringIO.StringIO()
+        with zipfile.ZipFile(data, 'w') as target:
+            for name in source.namelist():
+                content = source.read(name)
+                if name == 'xl/worksheets/sheet1.xml':
+                    content = re.sub(r'<dimension ref="[^"]*"',
+                                     '<dimension ref="A1:C2"', content)
+                target.writestr(name, content)
+        rows = list(read_rows(upload(data.getvalue()), cache=None))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[5][0], 'a5')
+
+    def test_xls_sheet_by_index(self):
+        infile = upload(open(xls_fn, 'rb').read())
+        rows = list(read_rows(infile, worksheet=2))
+        self.assertEqual(rows[0][0], u'Data File Name: '
+                                     u'C:\\msdchem\\1\\DATA\\9TR0447C3.D')
+
+    def test_sheet_not_found(self):
+        infile = upload(open(xls_fn, 'rb').read())
+        self.assertRaises(SheetNotFound, read_rows, infile, 'Missing')
+        infile = upload(open(xlsx_fn, 'rb').read())
+        self.assertRaises(SheetNotFound, read_rows, infile, 'Missing')
+
+    def test_spooled_upload(self):
+        for fn, worksheet in ((xls_fn, 2), (xlsx_fn, 0), (csv_fn, 0)):
+            data = open(fn, 'rb').read()
+            rows = list(read_rows(upload(data), worksheet=worksheet))
+            spooled = read_rows(upload(data), worksheet=worksheet, threshold=0)
+            self.assertEqual(list(spooled), rows)
+
+    def test_sheet_cache(self):
+        data = open(xlsx_fn, 'rb').read()
+        for cache in (SheetCache(), SheetCache(max_rows=2)):
+            rows = list(read_rows(upload(data), cache=cache))
+            self.assertEqual(len(cache._entries), 1)
+            self.assertEqual(list(read_rows(upload(data), cache=cache)), rows)
+            cache.clear()
+
+        # sheets which are not read to the end are not cached
+        cache = SheetCache()
+        next(read_rows(upload(data), cache=cache))
+        self.assertEqual(len(cache._entries), 0)
+
+    def test_csv_with_bom(self):
+        text = open(csv_fn, 'rb').read().decode('utf8')
+        infile = upload(codecs.BOM_UTF16_LE + text.encode('utf-16-le'))
+        rows = list(dict_rows(read_rows(infile)))
+        self.assertEqual(rows[0][1]['Sample ID'], 'DU-0001')
+        self.assertEqual(rows[0][1]['Reported Conc (Calib)'], '0.111')
+
+    def test_expand_uploads(self):
+        xlsx = open(xlsx_fn, 'rb').read()
+        csv = open(csv_fn, 'rb').read()
+        archive = cStringIO.StringIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('tray/', '')
+            zf.writestr('tray/DU-0001.xlsx', xlsx)
+            zf.writestr('tray/DU-0002.csv', csv)
+            zf.writestr('tray/.DS_Store', '')
+            zf.writestr('__MACOSX/tray/._DU-0002.csv', '')
+        files = expand_uploads([upload(archive.getvalue(), 'tray.zip'),
+                                upload(xlsx, 'DU-0003.xlsx')])
+        self.assertEqual([f.filename for f in files],
+                         ['DU-0001.xlsx', 'DU-0002.csv', 'DU-0003.xlsx'])
+        self.assertEqual(files[0].read(), xlsx)
+        self.assertEqual(files[1].read(), csv)
+        self.assertEqual(files[2].read(), xlsx)
+
+    def test_expand_invalid_archive(self):
+        csv = open(csv_fn, 'rb').read()
+        broken = upload('PK\x03\x04broken', 'broken.zip')
+        invalid = []
+        files = expand_uploads([broken, upload(csv, 'DU-0002.csv')],
+                               invalid=invalid)
+        self.assertEqual([f.filename for f in files], ['DU-0002.csv'])
+        self.assertEqual(invalid, [broken])
+        self.assertRaises(zipfile.BadZipfile, expand_uploads, [broken])
+
+
+class SampleParser(TabularInstrumentParser):
+
+    def get_sample_id(self, row):
+        return row['Sample ID']
+
+    def prefetch_samples(self, sample_ids):
+        self.prefetched = sorted(sample_ids)
+
+    def parse_row(self, row_nr, row):
+        # rows are streamed, the samples were resolved before
+        self.parsed.append((row_nr, self._rows, self.prefetched))
+        self._addRawResult(row['Sample ID'], {'reading': row_nr})
+
+
+class TestTabularInstrumentParser(unittest.TestCase):
+
+    def get_parser(self):
+        parser = SampleParser(upload(open(csv_fn, 'rb').read(), 'w.csv'))
+        parser.prefetched = None
+        parser.parsed = []
+        return parser
+
+    def test_rows_are_streamed(self):
+        parser = self.get_parser()
+        parser.parse()
+        self.assertEqual(parser.prefetched, ['DU-0001', 'DU-0002'])
+        self.assertTrue(parser.parsed)
+        for row_nr, rows, prefetched in parser.parsed:
+            self.assertIsNone(rows)
+            self.assertEqual(prefetched, ['DU-0001', 'DU-0002'])
+        self.assertEqual(sorted(parser.getRawResults()),
+                         ['DU-0001', 'DU-0002'])
+
+    def test_preloaded_rows_are_not_read_again(self):
+        calls = []
+
+        def counting_read_rows(*args, **kwargs):
+            calls.append(args)
+            return read_rows(*args, **kwargs)
+
+        parser = self.get_parser()
+        instrument.read_rows = counting_read_rows
+        try:
+            parser.preload_rows()
+            parser.parse()
+        finally:
+            instrument.read_rows = read_rows
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(parser.getRawResults()),
+                         ['DU-0001', 'DU-0002'])
+        self.assertIsNone(parser._rows)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRowSources))
+    suite.addTest(unittest.makeSuite(TestTabularInstrumentParser))
+    return suite
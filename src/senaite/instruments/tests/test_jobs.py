@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+import cStringIO
+import json
+import os
+
+import transaction
+import unittest2 as unittest
+import Zope2
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import setRoles
+
+from senaite.instruments import jobs
+from senaite.instruments.jobs import DONE
+from senaite.instruments.jobs import ImportJob
+from senaite.instruments.jobs import run_job
+from senaite.instruments.tests import TestFile
+from senaite.instruments.tests.base import BaseTestCase
+from zope.component import getMultiAdapter
+from zope.component.hooks import setSite
+from zope.globalrequest import getRequest
+from zope.publisher.browser import FileUpload
+from zope.publisher.browser import TestRequest
+
+
+def upload(data, filename):
+    return FileUpload(TestFile(cStringIO.StringIO(data), filename))
+
+
+def set_title(title, doom=False):
+    """Return an import func setting the title of its context
+    """
+    def Import(context, request):
+        context.setTitle(title)
+        if doom:
+            transaction.doom()
+        return json.dumps({"errors": [],
+                           "log": [request.form["note"]],
+                           "warns": []})
+    return Import
+
+
+class TestImportJob(BaseTestCase):
+
+    def setUp(self):
+        super(TestImportJob, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+
+    def get_job(self, func=None, **form):
+        request = TestRequest(form=form)
+        return ImportJob(func, self.portal, request)
+
+    def run_in_worker(self, job):
+        """Run the job with a connection of its own, like the worker does
+        """
+        db = self.layer['zodbDB']
+        app = Zope2.app
+        Zope2.app = lambda: db.open().root()['Application']
+        try:
+            run_job(job)
+        finally:
+            Zope2.app = app
+            setSite(self.portal)
+            login(self.portal, TEST_USER_NAME)
+        transaction.begin()
+
+    def test_form(self):
+        job = self.get_job(
+            instrument_results_file=upload('a,b', 'a.csv'),
+            tray=[upload('c', 'c.csv'), upload('d', 'd.csv')],
+            artoapply='received',
+            async_import='1')
+        self.assertEqual(job.form, {'artoapply': 'received'})
+        self.assertEqual(job.user_id, TEST_USER_ID)
+        form = job.get_form()
+        self.assertNotIn('async_import', form)
+        self.assertEqual(form['artoapply'], 'received')
+        results_file = form['instrument_results_file']
+        self.assertEqual(results_file.filename, 'a.csv')
+        self.assertEqual(results_file.read(), 'a,b')
+        self.assertEqual([(f.filename, f.read()) for f in form['tray']],
+                         [('c.csv', 'c'), ('d.csv', 'd')])
+        paths = [path for files, is_list in job.uploads.values()
+                 for filename, path in files]
+        self.assertEqual(len(paths), 3)
+        for value in form.values():
+            for f in value if isinstance(value, list) else [value]:
+                if isinstance(f, FileUpload):
+                    f.close()
+        job.cleanup()
+        self.assertFalse(filter(os.path.exists, paths))
+
+    def test_run_job_commits(self):
+        transaction.commit()
+        job = self.get_job(set_title('Imported'), note='committed')
+        self.run_in_worker(job)
+        self.assertEqual(job.state, DONE)
+        self.assertEqual(job.result['log'], ['committed'])
+        self.assertEqual(self.portal.Title(), 'Imported')
+
+    def test_run_job_aborts_doomed_transaction(self):
+        title = self.portal.Title()
+        transaction.commit()
+        job = self.get_job(set_title('Dry run', doom=True), note='aborted')
+        self.run_in_worker(job)
+        self.assertEqual(job.state, DONE)
+        self.assertEqual(job.result['log'], ['aborted'])
+        self.assertEqual(self.portal.Title(), title)
+
+    def test_run_job_sets_global_request(self):
+        requests = []
+
+        def Import(context, request):
+            requests.append((request, getRequest()))
+            return json.dumps({"errors": [], "log": [], "warns": []})
+
+        job = self.get_job(Import)
+        self.run_in_worker(job)
+        self.assertEqual(job.state, DONE)
+        request, global_request = requests[0]
+        self.assertIs(global_request, request)
+        self.assertIsNone(getRequest())
+
+    def test_status_of_other_users_job(self):
+        job = self.get_job(note='status')
+        jobs._jobs[job.id] = job
+        try:
+            request = TestRequest(form=dict(job_id=job.id))
+            view = getMultiAdapter((self.portal, request),
+                                   name='instrument_import_status')
+            data = json.loads(view())
+            self.assertEqual(data['job_id'], job.id)
+            self.assertEqual(data['state'], job.state)
+
+            self.portal.acl_users.userFolderAddUser(
+                'other', 'secret', ['Member'], [])
+            login(self.portal, 'other')
+            request = TestRequest(form=dict(job_id=job.id))
+            view = getMultiAdapter((self.portal, request),
+                                   name='instrument_import_status')
+            data = json.loads(view())
+            self.assertEqual(request.response.getStatus(), 404)
+            self.assertNotIn('job_id', data)
+        finally:
+            del jobs._jobs[job.id]
+            job.cleanup()
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestImportJob))
+    return suite
@@ -4,6 +4,7 @@
 #
 # Copyright 2018 by it's authors.
 import cStringIO
+import json
 from datetime import datetime
 from os.path import abspath
 from os.path import dirname
@@ -108,6 +109,59 @@ class TestWinlab32(BaseTestCase):
         self.assertEqual(ag.getResult(), '0.111')
         self.assertEqual(al.getResult(), '0.222')
 
+    def test_dry_run(self):
+        ar = self.add_analysisrequest(
+            self.client,
+            dict(Client=self.client.UID(),
+                 Contact=self.contact.UID(),
+                 DateSampled=datetime.now().date().isoformat(),
+                 SampleType=self.sampletype.UID()),
+            [srv.UID() for srv in self.services])
+        api.do_transition_for(ar, 'receive')
+        data = open(fn, 'r').read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), fn))
+        request = TestRequest(form=dict(
+            submitted=True,
+            artoapply='received_tobeverified',
+            results_override='override',
+            instrument_results_file=import_file,
+            instrument=api.get_uid(self.instrument),
+            dry_run='1'))
+        results = json.loads(importer.Import(self.portal, request))
+        ag = ar.getAnalyses(full_objects=True, getKeyword='Ag107')[0]
+        self.assertFalse(ag.getResult())
+        rows = results['dry_run']['rows']
+        self.assertEqual(rows[0]['sample_id'], ar.getId())
+        self.assertTrue(rows[0]['sample_found'])
+        self.assertEqual(rows[0]['keywords'], ['Ag107'])
+        self.assertEqual(rows[1]['keywords'], ['Al27'])
+        self.assertEqual(results['dry_run']['samples'], 1)
+
+    def test_dry_run_sample_states(self):
+        # the sample is not received, so the import would leave it out
+        ar = self.add_analysisrequest(
+            self.client,
+            dict(Client=self.client.UID(),
+                 Contact=self.contact.UID(),
+                 DateSampled=datetime.now().date().isoformat(),
+                 SampleType=self.sampletype.UID()),
+            [srv.UID() for srv in self.services])
+        data = open(fn, 'r').read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), fn))
+        request = TestRequest(form=dict(
+            submitted=True,
+            artoapply='received',
+            results_override='override',
+            instrument_results_file=import_file,
+            instrument=api.get_uid(self.instrument),
+            dry_run='1'))
+        results = json.loads(importer.Import(self.portal, request))
+        rows = results['dry_run']['rows']
+        self.assertEqual(rows[0]['sample_id'], ar.getId())
+        self.assertFalse(rows[0]['sample_found'])
+        self.assertEqual(rows[0]['keywords'], [])
+        self.assertEqual(results['dry_run']['samples'], 0)
+
 
 def test_suite():
     suite = unittest.TestSuite()
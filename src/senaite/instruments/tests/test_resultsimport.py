@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+import cStringIO
+import time
+
+import transaction
+import unittest2 as unittest
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import setRoles
+
+from senaite.core.exportimport.instruments.resultsimport import \
+    InstrumentResultsFileParser
+from senaite.instruments import resultsimport
+from senaite.instruments.resultsimport import CHECKPOINT_DAYS
+from senaite.instruments.resultsimport import CONFLICT_BACKOFF
+from senaite.instruments.resultsimport import CONFLICT_BACKOFF_MAX
+from senaite.instruments.resultsimport import CONFLICT_RETRIES
+from senaite.instruments.resultsimport import ChunkParser
+from senaite.instruments.resultsimport import ChunkedAnalysisResultsImporter
+from senaite.instruments.resultsimport import conflict_backoff
+from senaite.instruments.resultsimport import get_checkpoint
+from senaite.instruments.resultsimport import get_checkpoints
+from senaite.instruments.tests import TestFile
+from senaite.instruments.tests.base import BaseTestCase
+from zope.publisher.browser import FileUpload
+from ZODB.POSException import ConflictError
+
+SAMPLE_IDS = ['S-%02d' % i for i in range(7)]
+
+
+class SampleParser(InstrumentResultsFileParser):
+
+    def __init__(self, data='S-00..S-06'):
+        InstrumentResultsFileParser.__init__(
+            self, FileUpload(TestFile(cStringIO.StringIO(data), 's.csv')),
+            'CSV')
+
+    def parse(self):
+        for sample_id in SAMPLE_IDS:
+            self._addRawResult(sample_id, {'Ag107': {
+                'DefaultResult': 'reading', 'reading': '1'}})
+        return True
+
+
+class ConflictingChunkParser(ChunkParser):
+
+    def parse(self):
+        raise ConflictError()
+
+
+class RecordingImporter(ChunkedAnalysisResultsImporter):
+    """Records the samples of the chunks, failing at the chunk with the
+    sample id interrupt_at, and raising conflict_times ConflictErrors for
+    the chunks with the sample id conflict_at
+    """
+
+    interrupt_at = None
+    conflict_at = None
+    conflict_times = 0
+
+    def get_chunk_parser(self, parser, results):
+        if self.interrupt_at in results:
+            raise ValueError("Interrupted")
+        if self.conflict_at in results and self.conflict_times:
+            self.conflict_times -= 1
+            return ConflictingChunkParser(parser, results)
+        self.chunks.append(sorted(results))
+        return ChunkedAnalysisResultsImporter.get_chunk_parser(
+            self, parser, results)
+
+
+class TestConflictBackoff(unittest.TestCase):
+
+    def test_backoff(self):
+        for attempt in range(1, 10):
+            delay = min(CONFLICT_BACKOFF * 2 ** (attempt - 1),
+                        CONFLICT_BACKOFF_MAX)
+            for i in range(20):
+                backoff = conflict_backoff(attempt)
+                self.assertGreaterEqual(backoff, delay / 2)
+                self.assertLessEqual(backoff, delay)
+        self.assertLessEqual(conflict_backoff(100), CONFLICT_BACKOFF_MAX)
+
+
+class TestChunkedImporter(BaseTestCase):
+
+    def setUp(self):
+        super(TestChunkedImporter, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+
+    def get_importer(self, parser=None, commit=False, **kwargs):
+        importer = RecordingImporter(
+            parser or SampleParser(), self.portal, chunk_size=3,
+            commit=commit, **kwargs)
+        importer.chunks = []
+        return importer
+
+    def test_chunks_and_savepoints(self):
+        savepoints = []
+        savepoint = transaction.savepoint
+
+        def counting_savepoint(*args, **kwargs):
+            savepoints.append(args)
+            return savepoint(*args, **kwargs)
+
+        importer = self.get_importer()
+        resultsimport.transaction.savepoint = counting_savepoint
+        try:
+            importer.process()
+        finally:
+            resultsimport.transaction.savepoint = savepoint
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[:3],
+                                           SAMPLE_IDS[3:6],
+                                           SAMPLE_IDS[6:]])
+        # one savepoint before every chunk
+        self.assertEqual(len(savepoints), 3)
+        # the summaries of the chunks are logged once
+        summaries = [msg for msg in importer.logs
+                     if msg.startswith('Import finished successfully')]
+        self.assertEqual(len(summaries), 1)
+
+    def test_checkpoint_resume(self):
+        transaction.commit()
+        importer = self.get_importer(commit=True)
+        importer.interrupt_at = 'S-04'
+        self.assertRaises(ValueError, importer.process)
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[:3]])
+        key = importer.get_checkpoint_key()
+        self.assertEqual(sorted(get_checkpoint(key)), SAMPLE_IDS[:3])
+
+        # other options do not resume the interrupted import
+        other = self.get_importer(commit=True, override=[True, True])
+        self.assertNotEqual(other.get_checkpoint_key(), key)
+        other = self.get_importer(SampleParser('other'), commit=True)
+        self.assertNotEqual(other.get_checkpoint_key(), key)
+
+        importer = self.get_importer(commit=True)
+        importer.process()
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[3:6], SAMPLE_IDS[6:]])
+        self.assertNotIn(key, get_checkpoints())
+
+    def interrupt(self):
+        """Import the first chunk only, return the key of the checkpoint
+        """
+        transaction.commit()
+        importer = self.get_importer(commit=True)
+        importer.interrupt_at = 'S-04'
+        self.assertRaises(ValueError, importer.process)
+        return importer.get_checkpoint_key()
+
+    def test_checkpoint_expires(self):
+        key = self.interrupt()
+        timestamp, objids = get_checkpoints()[key]
+        get_checkpoints()[key] = (
+            timestamp - CHECKPOINT_DAYS * 24 * 3600 - 1, objids)
+        importer = self.get_importer(commit=True)
+        importer.process()
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[:3],
+                                           SAMPLE_IDS[3:6],
+                                           SAMPLE_IDS[6:]])
+        self.assertNotIn(key, get_checkpoints())
+
+    def test_checkpoint_restart(self):
+        key = self.interrupt()
+        self.assertTrue(get_checkpoint(key))
+        importer = self.get_importer(commit=True, restart=True)
+        importer.process()
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[:3],
+                                           SAMPLE_IDS[3:6],
+                                           SAMPLE_IDS[6:]])
+        self.assertFalse([msg for msg in importer.logs
+                          if msg.startswith('Resuming import')])
+
+    def test_checkpoint_time(self):
+        before = time.time()
+        key = self.interrupt()
+        timestamp, objids = get_checkpoints()[key]
+        self.assertGreaterEqual(timestamp, before)
+        self.assertLessEqual(timestamp, time.time())
+
+
+class TestConflictRetries(BaseTestCase):
+
+    def setUp(self):
+        super(TestConflictRetries, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+        transaction.commit()
+
+    def process(self, conflict_times, commit=True):
+        """Import with conflict_times conflicts of the chunks with S-04,
+        return the importer and the number of aborts
+        """
+        aborts = []
+        abort = transaction.abort
+
+        def counting_abort(*args, **kwargs):
+            aborts.append(args)
+            return abort(*args, **kwargs)
+
+        importer = RecordingImporter(
+            SampleParser(), self.portal, chunk_size=3, commit=commit)
+        importer.chunks = []
+        importer.conflict_at = 'S-04'
+        importer.conflict_times = conflict_times
+        resultsimport.transaction.abort = counting_abort
+        resultsimport.conflict_backoff = lambda attempt: 0
+        try:
+            importer.process()
+        finally:
+            resultsimport.transaction.abort = abort
+            resultsimport.conflict_backoff = conflict_backoff
+        return importer, len(aborts)
+
+    def test_retry(self):
+        importer, aborts = self.process(2)
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[:3],
+                                           SAMPLE_IDS[3:6],
+                                           SAMPLE_IDS[6:]])
+        self.assertEqual(importer.conflicts,
+                         {'count': 2, 'retries': 2, 'failed': []})
+        # every conflict is rolled back
+        self.assertEqual(aborts, 2)
+        self.assertFalse(importer.errors)
+        self.assertNotIn(importer.get_checkpoint_key(), get_checkpoints())
+
+    def test_give_up(self):
+        attempts = CONFLICT_RETRIES + 1
+        importer, aborts = self.process(2 * attempts)
+        # the chunk in conflict is applied sample by sample
+        self.assertEqual(importer.chunks, [SAMPLE_IDS[:3],
+                                           ['S-03'],
+                                           ['S-05'],
+                                           SAMPLE_IDS[6:]])
+        self.assertEqual(importer.conflicts,
+                         {'count': 2 * attempts,
+                          'retries': 2 * CONFLICT_RETRIES,
+                          'failed': ['S-04']})
+        self.assertEqual(aborts, 2 * attempts)
+        self.assertEqual(len(importer.errors), 1)
+        self.assertIn('S-04', importer.errors[0])
+        # the sample left out is imported when the file is imported again
+        done = get_checkpoint(importer.get_checkpoint_key())
+        self.assertEqual(sorted(done),
+                         [sid for sid in SAMPLE_IDS if sid != 'S-04'])
+
+    def test_no_retry_without_commit(self):
+        # the publisher retries the request instead
+        self.assertRaises(ConflictError, self.process, 1, commit=False)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestConflictBackoff))
+    suite.addTest(unittest.makeSuite(TestChunkedImporter))
+    suite.addTest(unittest.makeSuite(TestConflictRetries))
+    return suite
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+import xml.etree.cElementTree as ET
+
+import unittest2 as unittest
+
+from senaite.instruments.sequence import build_sequence
+from senaite.instruments.sequence import write_csv
+from senaite.instruments.sequence import write_xml
+
+
+class Response(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+class TestSequenceWriter(unittest.TestCase):
+
+    def test_build_sequence(self):
+        layout = [
+            {'position': '3', 'parent_uid': 'p3', 'container_uid': 'c3a'},
+            {'position': '3', 'parent_uid': 'p3', 'container_uid': 'c3b'},
+            {'position': '1', 'parent_uid': 'p1', 'container_uid': 'c1'},
+            {'position': '2', 'parent_uid': '', 'container_uid': 'c2'},
+            {'position': '1', 'parent_uid': 'p0', 'container_uid': 'c0'},
+        ]
+        sequence = build_sequence(layout, lambda slot: slot['parent_uid'])
+        self.assertEqual([(cup, parent, slot['container_uid'])
+                          for cup, parent, slot in sequence],
+                         [(1, 'p1', 'c1'), (1, 'p0', 'c0'), (3, 'p3', 'c3a')])
+
+    def test_write_csv(self):
+        rows = [['header', 'F SO2 & T SO2']]
+        rows.extend([1, i, 'p', ''] for i in range(3))
+        response = Response()
+        write_csv(response, iter(rows), delimiter=';', chunk_size=20)
+        self.assertEqual(''.join(response.chunks),
+                         'header;F SO2 & T SO2\r\n'
+                         '1;0;p;\r\n1;1;p;\r\n1;2;p;\r\n')
+
+    def elements(self):
+        for i in range(3):
+            seq = ET.Element('Sequence')
+            ET.SubElement(seq, 'SampleName').text = u'S-%s <\xe9>' % i
+            yield seq
+
+    def test_write_xml(self):
+        attributes = [('b', '1 & "2"'), ('a', '')]
+        root = ET.Element('Root')
+        for name, value in attributes:
+            root.set(name, value)
+        root.extend(self.elements())
+
+        response = Response()
+        write_xml(response, 'Root', attributes, self.elements())
+        self.assertEqual(len(response.chunks), 1)
+        self.assertEqual(response.chunks[0], ET.tostring(root))
+
+        response = Response()
+        write_xml(response, 'Root', attributes, self.elements(), chunk_size=1)
+        self.assertEqual(len(response.chunks), 5)
+        self.assertEqual(''.join(response.chunks), ET.tostring(root))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSequenceWriter))
+    return suite
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+import unittest2 as unittest
+
+from senaite.instruments.utils import KeywordIndex
+
+
+class TestKeywordIndex(unittest.TestCase):
+
+    def test_startswith(self):
+        index = KeywordIndex(Ag107='ag', Al27='al', Al27x='alx', Be9='be')
+        self.assertEqual(index.startswith('Ag107'), ['ag'])
+        self.assertEqual(index.startswith('Al27'), ['al', 'alx'])
+        self.assertEqual(index.startswith('B'), ['be'])
+        self.assertEqual(index.startswith('Cu'), [])
+        self.assertEqual(index.startswith('Z'), [])
+        self.assertEqual(len(index.startswith('')), 4)
+        self.assertEqual(index['Be9'], 'be')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestKeywordIndex))
+    return suite
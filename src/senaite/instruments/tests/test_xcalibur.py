@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+import cStringIO
+from datetime import datetime
+
+import unittest2 as unittest
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import setRoles
+
+from bika.lims import api
+from senaite.instruments.instruments.xcalibur.instrument import \
+    XCaliburCSVParser
+from senaite.instruments.instruments.xcalibur.instrument import \
+    find_interim_owners
+from senaite.instruments.tests import TestFile
+from senaite.instruments.tests.base import BaseTestCase
+from senaite.instruments.utils import get_service_keywords
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.publisher.browser import FileUpload
+
+service_interims = [
+    dict(keyword='FA', title='Free A', hidden=False),
+    dict(keyword='FB', title='Free B', hidden=False)
+]
+
+
+class TestXCalibur(BaseTestCase):
+
+    def setUp(self):
+        super(TestXCalibur, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+
+        self.client = self.add_client(title='Happy Hills', ClientID='HH')
+
+        self.contact = self.add_contact(
+            self.client, Firstname='Rita', Surname='Mohale')
+
+        self.calculation = self.add_calculation(
+            title='Free SO2', Formula='[FA] + [FB]',
+            InterimFields=service_interims)
+
+        category = self.add_analysiscategory(title='Wine')
+        self.services = [
+            self.add_analysisservice(
+                title='Copper',
+                Keyword='Cu',
+                PointOfCapture='lab',
+                Category=category),
+            self.add_analysisservice(
+                title='Free SO2',
+                Keyword='FSO2',
+                PointOfCapture='lab',
+                Category=category,
+                Calculation='Free SO2',
+                InterimFields=service_interims)
+        ]
+        self.sampletype = self.add_sampletype(
+            title='Dust', RetentionPeriod=dict(days=1),
+            MinimumVolume='1 kg', Prefix='DU')
+
+    def add_sample(self):
+        ar = self.add_analysisrequest(
+            self.client,
+            dict(Client=self.client.UID(),
+                 Contact=self.contact.UID(),
+                 DateSampled=datetime.now().date().isoformat(),
+                 SampleType=self.sampletype.UID()),
+            [srv.UID() for srv in self.services])
+        api.do_transition_for(ar, 'receive')
+        return ar
+
+    def get_parser(self, data):
+        fn = 'xcalibur.csv'
+        return XCaliburCSVParser(
+            FileUpload(TestFile(cStringIO.StringIO(data), fn)))
+
+    def test_compile_columns(self):
+        columns = XCaliburCSVParser.compile_columns(
+            ['Cu', 'F-SO2', 'FA', 'Zz'])
+        self.assertEqual(columns, [('Cu', True),
+                                   ('FSO2', True),
+                                   ('FA', False),
+                                   ('Zz', False)])
+
+    def test_interim_grouping(self):
+        ar = self.add_sample()
+        sample_id = ar.getId()
+        data = '\n'.join([
+            'list,method',
+            'x,Cu,FA,FB,Zz,end',
+            '{},1.5,10,11,7,'.format(sample_id),
+            'end'])
+        parser = self.get_parser(data)
+        parser.parse()
+        results = parser.getRawResults()[sample_id]
+        # one record per service column, one per interim owner
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['Cu']['resultValue'], 1.5)
+        self.assertEqual(results[1]['Zz']['resultValue'], 7.0)
+        self.assertEqual(results[2]['FSO2'],
+                         {'AR': sample_id,
+                          'DefaultResult': 'resultValue',
+                          'FA': '10',
+                          'FB': '11'})
+
+    def test_shared_interim_owner(self):
+        # added last, but first in alphabetical order
+        self.services.append(self.add_analysisservice(
+            title='Bound SO2',
+            Keyword='BSO2',
+            PointOfCapture='lab',
+            Category=self.add_analysiscategory(title='Sulphur'),
+            InterimFields=service_interims[:1]))
+        ar = self.add_sample()
+        sample_id = ar.getId()
+        parser = self.get_parser('')
+        parser.prefetch_samples([sample_id])
+        owners = parser.get_interim_owners(sample_id)
+        self.assertEqual(owners, {'FA': 'BSO2', 'FB': 'FSO2'})
+        # the prefetch and the lookup of a single sample agree
+        self.assertEqual(find_interim_owners(sample_id), owners)
+
+    def test_service_keywords_cache(self):
+        keywords = get_service_keywords()
+        self.assertIn('Cu', keywords)
+        self.assertIn('FSO2', keywords)
+        self.assertIs(get_service_keywords(), keywords)
+
+        # adding a service drops the cached keywords
+        service = self.add_analysisservice(
+            title='Iron', Keyword='Fe', PointOfCapture='lab',
+            Category=self.add_analysiscategory(title='Metals'))
+        self.assertIn('Fe', get_service_keywords())
+
+        # and so does modifying one
+        service.setKeyword('Fe56')
+        service.reindexObject()
+        notify(ObjectModifiedEvent(service))
+        keywords = get_service_keywords()
+        self.assertIn('Fe56', keywords)
+        self.assertNotIn('Fe', keywords)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestXCalibur))
+    return suite
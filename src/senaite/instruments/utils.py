@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS
+#
+# Copyright 2018 by it's authors.
+
+from bisect import bisect_left
+from time import time
+
+import transaction
+from bika.lims import api
+from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
+from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
+
+# Seconds after which the cached service keywords are reloaded anyway, so
+# other ZEO clients pick up changes they did not receive the events of
+SERVICE_KEYWORDS_TTL = 300
+
+# site path -> (load time, frozenset of keywords)
+_service_keywords = {}
+
+
+def get_samples(sample_ids, review_state=None):
+    """Return a dict of sample id -> sample catalog brain for the given ids
+
+    All samples are looked up with a single catalog query, optionally
+    restricted to the given review states; ids without a sample are left
+    out of the result. No sample object is woken up.
+    """
+    sample_ids = list(set(filter(None, sample_ids)))
+    if not sample_ids:
+        return {}
+    query = dict(portal_type="AnalysisRequest", getId=sample_ids)
+    if review_state:
+        query["review_state"] = review_state
+    brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
+    return dict((brain.getId, brain) for brain in brains)
+
+
+def resolve_sample_ids(ids):
+    """Return a dict of id -> sample id for the given sample ids or client
+    sample ids
+
+    Ids which are no sample id are looked up as client sample ids, which
+    must match a single sample. Unknown ids are left out of the result.
+    """
+    ids = set(filter(None, ids))
+    samples = get_samples(ids)
+    resolved = dict((sample_id, sample_id) for sample_id in samples)
+    missing = list(ids.difference(samples))
+    if missing:
+        query = dict(portal_type="AnalysisRequest", getClientSampleID=missing)
+        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
+        matches = {}
+        for brain in brains:
+            matches.setdefault(brain.getClientSampleID, []).append(brain.getId)
+        for client_sample_id, sample_ids in matches.items():
+            if len(sample_ids) == 1:
+                resolved[client_sample_id] = sample_ids[0]
+    return resolved
+
+
+def get_analyses_by_sample(sample_ids, review_state=None):
+    """Return a dict of sample id -> KeywordIndex of keyword -> analysis brain
+
+    The analyses of all samples are looked up with a single analysis catalog
+    query, optionally restricted to the given review states. Every sample id
+    gets an index, empty when it has no analyses.
+    """
+    sample_ids = list(set(filter(None, sample_ids)))
+    if not sample_ids:
+        return {}
+    query = dict(portal_type="Analysis", getRequestID=sample_ids)
+    if review_state:
+        query["review_state"] = review_state
+    analyses = dict((sample_id, {}) for sample_id in sample_ids)
+    for brain in api.search(query, CATALOG_ANALYSIS_LISTING):
+        analyses[brain.getRequestID][brain.getKeyword] = brain
+    return dict((sample_id, KeywordIndex(keywords))
+                for sample_id, keywords in analyses.items())
+
+
+def get_parent_uids(analysis_uids):
+    """Return a dict of analysis uid -> uid of the analysis' parent
+
+    The parents are read from the analysis catalog metadata with a single
+    query. Analyses missing there are woken up to get their parent.
+    """
+    analysis_uids = list(set(filter(None, analysis_uids)))
+    if not analysis_uids:
+        return {}
+    query = dict(UID=analysis_uids)
+    brains = api.search(query, CATALOG_ANALYSIS_LISTING)
+    parents = dict((brain.UID, brain.getParentUID) for brain in brains
+                   if brain.getParentUID)
+    uc = api.get_tool("uid_catalog")
+    for uid in set(analysis_uids).difference(parents):
+        parents[uid] = uc(UID=uid)[0].getObject().aq_parent.UID()
+    return parents
+
+
+def get_sample_titles(sample_uids):
+    """Return a dict of sample uid -> (title, sample type title)
+
+    The titles are read from the sample listing catalog metadata with a
+    single query. Uids which are no samples are left out of the result.
+    """
+    sample_uids = list(set(filter(None, sample_uids)))
+    if not sample_uids:
+        return {}
+    query = dict(UID=sample_uids)
+    brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
+    return dict((brain.UID, (brain.Title, brain.getSampleTypeTitle))
+                for brain in brains)
+
+
+class KeywordIndex(dict):
+    """Dict of keyword -> value with a sorted index of the keys for
+    prefix lookups
+
+    The index is built on creation, the dict is not meant to be changed
+    afterwards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._keys = sorted(self.keys())
+
+    def startswith(self, prefix):
+        """Return the values of all keys starting with prefix
+        """
+        keys = self._keys
+        values = []
+        pos = bisect_left(keys, prefix)
+        while pos < len(keys) and keys[pos].startswith(prefix):
+            values.append(self[keys[pos]])
+            pos += 1
+        return values
+
+
+def get_service_keywords():
+    """Return the set of keywords of the setup catalog, e.g. of all
+    analysis services
+
+    The set is loaded once per site and process, and dropped whenever an
+    analysis service is added, modified or removed.
+    """
+    key = api.get_path(api.get_portal())
+    entry = _service_keywords.get(key)
+    if entry is None or time() - entry[0] > SERVICE_KEYWORDS_TTL:
+        bsc = api.get_tool("bika_setup_catalog")
+        entry = (time(), frozenset(bsc.uniqueValuesFor("getKeyword")))
+        _service_keywords[key] = entry
+    return entry[1]
+
+
+def clear_service_keywords(service=None, event=None):
+    """Event handler dropping the cached service keywords
+
+    The cache is dropped again after the commit, as other threads may have
+    reloaded it from the catalog before the change was committed.
+    """
+    _service_keywords.clear()
+    transaction.get().addAfterCommitHook(
+        lambda status: _service_keywords.clear())